@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 
+from numbers import Number
+
 import yaml
-from ooi_data.postgres.model import *
 
 from tools.m2m import MachineToMachine
-from database import create_engine_from_url, create_scoped_session
+from catalog import create_catalog
 
-engine = create_engine_from_url(None)
-session = create_scoped_session(engine)
+PRELOAD_TABLES = ['parameter', 'parameter_type', 'stream', 'stream_parameter']
 
-MetadataBase.query = session.query_property()
+catalog = create_catalog(tables=PRELOAD_TABLES)
 
 
 def build_dpi_map():
@@ -17,11 +17,7 @@ def build_dpi_map():
     Build a map from a specific data product identifier to a set of parameters which fulfill it
     :return:
     """
-    dpi_map = {}
-    for p in Parameter.query:
-        if p.data_product_identifier:
-            dpi_map.setdefault(p.data_product_identifier, set()).add(p)
-    return dpi_map
+    return {dpi: set(parameters) for dpi, parameters in catalog.parameters_by_dpi.items()}
 
 
 def build_affects_map():
@@ -31,7 +27,7 @@ def build_affects_map():
     """
     dpi_map = build_dpi_map()
     affects_map = {}
-    for p in Parameter.query:
+    for p in catalog.parameters.values():
         if p.is_function:
             pmap = p.parameter_function_map
             for key in pmap:
@@ -48,7 +44,7 @@ def build_affects_map():
 
                     if 'PD' in value:
                         pdid = int(value.split('PD')[-1])
-                        param = Parameter.query.get(pdid)
+                        param = catalog.get_parameter(pdid)
                         affects_map.setdefault(param, set()).add(p)
     return affects_map
 
@@ -62,7 +58,7 @@ def parameter_affects(pdid, affects_map):
     :param affects_map:
     :return:
     """
-    p = Parameter.query.get(pdid)
+    p = catalog.get_parameter(pdid)
 
     affected = {p}
     to_visit = affects_map[p]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Usage:
+    cold_load.py [--repeat=<n>] [<url>]
+
+Options:
+    --repeat=<n>  Number of cold loads timed for each case [default: 3]
+
+    Time loading the CSV files into an empty preload database: the value tables
+    alone, committing each new value (the previous behaviour of process_value_table)
+    and inserting them in bulk, then the whole of load_preload.update_db.
+
+    Without a URL each load uses a new SQLite file in a temporary directory. The
+    preload tables of a database given by URL (e.g. a local Postgres) are DROPPED
+    and recreated before each load, so never point this at a database you need.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import load_preload
+from ooi_data.postgres.model import MetadataBase
+from ooi_data.postgres.model.preload import preload_tables
+
+
+def process_value_table_per_row(session, dataframe, name, klass):
+    # process_value_table before bulk inserts, one transaction per new value
+    all_values = {item.value: item.id for item in session.query(klass)}
+    csv_values = set(load_preload.iter_value_table_values(dataframe[name]))
+    for each in sorted(csv_values.difference(all_values)):
+        new_item = klass(value=each)
+        session.add(new_item)
+        session.commit()
+        all_values[each] = new_item.id
+    return all_values
+
+
+def load_value_tables(session, process):
+    for framename, value_map in load_preload.value_table_map_map.items():
+        for name, klass in value_map.items():
+            process(session, load_preload.dataframes[framename], name, klass)
+
+
+def cold_load(url, load):
+    directory = None
+    if url is None:
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///%s' % os.path.join(directory, 'preload.sqlite')
+    engine = database.create_engine_from_url(url)
+    try:
+        MetadataBase.metadata.drop_all(bind=engine, tables=preload_tables)
+        database.preload_row_hash.drop(bind=engine, checkfirst=True)
+        MetadataBase.metadata.create_all(bind=engine, tables=preload_tables)
+        database.preload_row_hash.create(bind=engine)
+
+        session = database.create_scoped_session(engine)()
+        start = time.time()
+        load(session)
+        elapsed = time.time() - start
+        session.close()
+        return elapsed
+    finally:
+        engine.dispose()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    url = options['<url>']
+    repeat = int(options['--repeat'])
+
+    load_preload.read_csv_data()
+    cases = [
+        ('value tables, commit per value', lambda s: load_value_tables(s, process_value_table_per_row)),
+        ('value tables, bulk', lambda s: load_value_tables(s, load_preload.process_value_table)),
+        ('update_db', load_preload.update_db),
+    ]
+
+    print 'Cold load into %s, best of %d' % (url or 'a new SQLite file', repeat)
+    for name, load in cases:
+        times = [cold_load(url, load) for _ in range(repeat)]
+        print '%-32s %8.3fs' % (name, min(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Usage:
+    lookup_indexes.py [--repeat=<n>]
+
+Options:
+    --repeat=<n>  Number of times each lookup is repeated [default: 200]
+
+    Time the lookups made by resolve_stream.py, list_stream_data.py and affected.py
+    against the preload catalog with and without the secondary indexes from
+    database.PRELOAD_INDEXES.
+"""
+import os
+import sqlite3
+import sys
+import time
+
+import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+LOOKUPS = [
+    ('stream by name', 'SELECT * FROM stream WHERE name = ?', 'SELECT name FROM stream'),
+    ('parameter by name', 'SELECT * FROM parameter WHERE name = ?', 'SELECT name FROM parameter'),
+    ('parameter by dpi', 'SELECT * FROM parameter WHERE data_product_identifier = ?',
+     'SELECT data_product_identifier FROM parameter WHERE data_product_identifier IS NOT NULL'),
+    ('streams for parameter', 'SELECT stream_id FROM stream_parameter WHERE parameter_id = ?',
+     'SELECT id FROM parameter'),
+    ('parameters for stream', 'SELECT parameter_id FROM stream_parameter WHERE stream_id = ?',
+     'SELECT id FROM stream'),
+    ('source streams', 'SELECT source_stream_id FROM stream_dependency WHERE product_stream_id = ?',
+     'SELECT id FROM stream'),
+    ('nominal depth', 'SELECT * FROM nominal_depth WHERE subsite = ? AND node = ? AND sensor = ?',
+     'SELECT subsite, node, sensor FROM nominal_depth'),
+    ('depth within', 'SELECT * FROM nominal_depth WHERE subsite = ? AND depth BETWEEN ? - 6 AND ? + 6',
+     'SELECT subsite, depth, depth FROM nominal_depth WHERE depth IS NOT NULL'),
+]
+
+
+def load(indexed):
+    connection = sqlite3.connect(':memory:')
+    connection.executescript(database.get_preload_database_script_as_string())
+    for name, _, _ in database.PRELOAD_INDEXES:
+        connection.execute('DROP INDEX IF EXISTS %s' % name)
+    if indexed:
+        database.create_preload_indexes(connection)
+    connection.execute('ANALYZE')
+    return connection
+
+
+def time_lookup(connection, query, keys, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for key in keys:
+            connection.execute(query, key).fetchall()
+    return (time.time() - start) / (repeat * len(keys))
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    repeat = int(options['--repeat'])
+
+    before = load(indexed=False)
+    after = load(indexed=True)
+
+    print '%-24s %14s %14s %8s' % ('lookup', 'before (us)', 'after (us)', 'speedup')
+    for label, query, key_query in LOOKUPS:
+        # sample up to 50 real keys from the catalog
+        keys = before.execute(key_query).fetchall()
+        keys = keys[::max(1, len(keys) // 50)]
+        t_before = time_lookup(before, query, keys, repeat)
+        t_after = time_lookup(after, query, keys, repeat)
+        print '%-24s %14.1f %14.1f %7.1fx' % (label, t_before * 1e6, t_after * 1e6, t_before / t_after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Usage:
+    read_csv.py [--repeat=<n>]
+    read_csv.py --worker (untyped|typed)
+
+Options:
+    --repeat=<n>  Number of times each reader is run [default: 5]
+
+    Compare the wall time and peak memory of reading the loader's CSV files one
+    after another with untyped pd.read_csv (the previous read_csv_data) against
+    load_preload.read_csv_data, which reads only the used columns as text
+    (converting load_preload.CSV_NUMERIC_COLUMNS to numbers) in one pass per
+    file, replaces missing values in place and reads the files in parallel
+    threads, one per CPU. Each run is made in a new process so its peak RSS
+    can be measured. Set PRELOAD_CSV_DIR to measure another catalog.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def read_csv_data_untyped(load_preload):
+    # read_csv_data before typed, parallel reading
+    import numpy as np
+    import pandas as pd
+    for csv_file in load_preload.CSV_FILES:
+        filepath = os.path.join(load_preload.CSV_DIR, '%s.csv' % csv_file)
+        df = pd.read_csv(filepath, encoding='utf-8')
+        if 'scenario' in df:
+            df = df[np.logical_not(df.scenario.str.startswith('DOC').fillna(False))]
+        load_preload.dataframes[csv_file] = df.where(pd.notnull(df), None)
+
+
+def worker(typed):
+    import database
+    import load_preload
+
+    _, start_rss = database.get_resource_usage()
+    start = time.time()
+    if typed:
+        load_preload.read_csv_data()
+    else:
+        read_csv_data_untyped(load_preload)
+    elapsed = time.time() - start
+    _, peak_rss = database.get_resource_usage()
+
+    print json.dumps({'seconds': elapsed, 'peak_rss_kb': peak_rss, 'peak_rss_growth_kb': peak_rss - start_rss})
+
+
+def run(mode, repeat):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode]
+    results = [json.loads(subprocess.check_output(command).splitlines()[-1]) for _ in range(repeat)]
+    print '%-8s wall best %6.3fs mean %6.3fs  peak RSS %8d kB  growth %8d kB' % (
+        mode, min(r['seconds'] for r in results), sum(r['seconds'] for r in results) / len(results),
+        max(r['peak_rss_kb'] for r in results), max(r['peak_rss_growth_kb'] for r in results))
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['--worker']:
+        worker(options['typed'])
+        return
+
+    repeat = int(options['--repeat'])
+    for mode in ['untyped', 'typed']:
+        run(mode, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Usage:
+    scalability.py [--scales=<list>] [--tools=<list>] [--output=<file>] [--keep=<dir>]
+    scalability.py --worker <scale>
+
+Options:
+    --scales=<list>  Comma separated sizes of the synthetic catalogs, as multiples of the
+                     current catalog [default: 1,10,100]
+    --tools=<list>   Comma separated tools to run on each catalog, in order
+                     [default: validate_preload,load_preload,generate_cql,resolve_stream]
+    --output=<file>  Also write the measurements to file as JSON
+    --keep=<dir>     Write the catalogs and tool output under dir and keep them, rather
+                     than in a temporary directory which is removed
+
+    Generate a synthetic catalog at each scale (see synthetic_catalog.py) and run
+    each tool on it in a new process, recording its wall time, exit status and peak
+    RSS (from os.wait4). load_preload.py builds the preload_database.sql the later
+    tools read, so keep it before them. resolve_stream.py is run offline by the
+    worker, which resolves every derived stream of the test stream map (copied for
+    each copy of the catalog) as resolve_stream.py does with no arguments.
+
+    For each scale after the first, growth is the ratio of the wall times divided
+    by the ratio of the scales: about 1 for a tool which scales linearly, well above
+    1 for one with a superlinear code path.
+"""
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+import synthetic_catalog
+
+STREAM_MAP = os.path.join(here, 'test', 'stream_map.p')
+
+
+def tool_command(tool, work_dir, scale):
+    # Command line of each tool, run in work_dir against its catalog
+    csv_dir = os.path.join(work_dir, 'csv')
+    commands = {
+        'validate_preload': [os.path.join(here, 'validate_preload.py'), '--csv-dir=%s' % csv_dir],
+        'load_preload': [os.path.join(here, 'load_preload.py')],
+        'generate_cql': [os.path.join(here, 'generate_cql.py')],
+        'resolve_stream': [os.path.abspath(__file__), '--worker', str(scale)],
+    }
+    return [sys.executable] + commands[tool]
+
+
+def run_tool(tool, work_dir, scale):
+    """Run tool on the catalog in work_dir, returning its wall time, exit status and peak RSS"""
+    env = dict(os.environ,
+               PRELOAD_CSV_DIR=os.path.join(work_dir, 'csv'),
+               PRELOAD_DATABASE_SCRIPT=os.path.join(work_dir, 'preload_database.sql'),
+               PRELOAD_CACHE_DIR=os.path.join(work_dir, 'cache'))
+    with open(os.devnull, 'w') as devnull, open(os.path.join(work_dir, '%s.log' % tool), 'w') as log:
+        start = time.time()
+        process = subprocess.Popen(tool_command(tool, work_dir, scale), cwd=work_dir, env=env,
+                                   stdout=devnull, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return {'tool': tool, 'scale': scale, 'seconds': round(elapsed, 3), 'status': process.returncode,
+            'peak_rss_kb': usage.ru_maxrss}
+
+
+def prepare(work_dir, scale):
+    # Write the synthetic catalog, generate_cql.py reads its templates from the working directory
+    synthetic_catalog.generate(os.path.join(work_dir, 'csv'), scale)
+    os.symlink(os.path.join(here, 'templates'), os.path.join(work_dir, 'templates'))
+
+
+class MachineToMachine(object):
+    """Offline stand-in for tools.m2m.MachineToMachine answering node inventories from a stream map"""
+    def __init__(self, stream_map):
+        self.nodes = {}
+        for refdes in stream_map:
+            self.nodes.setdefault(tuple(refdes.split('-', 2)[:2]), []).append(refdes)
+
+    def node_inventory(self, subsite, node):
+        return self.nodes.get((subsite, node), [])
+
+
+def synthetic_stream_map(scale):
+    # The test stream map with each copy of the catalog deployed on the instruments of its own subsites
+    with open(STREAM_MAP, 'rb') as fh:
+        stream_map = pickle.load(fh)
+    return {synthetic_catalog.copy_designator(refdes, copy): {
+        method: {synthetic_catalog.copy_name(stream, copy) for stream in streams}
+        for method, streams in methods.items()}
+        for copy in range(scale) for refdes, methods in stream_map.items()}
+
+
+def worker(scale):
+    # resolve_stream.py without arguments, offline, skipping streams which are not in the catalog
+    import resolve_stream
+
+    stream_map = synthetic_stream_map(scale)
+    m2m = MachineToMachine(stream_map)
+    resolved = 0
+    for refdes in sorted(stream_map):
+        for method in sorted(stream_map[refdes]):
+            if method.startswith('bad'):
+                continue
+            for stream in sorted(stream_map[refdes][method]):
+                if resolve_stream.catalog.get_stream_by_name(stream) is None:
+                    continue
+                if resolve_stream.has_functions(stream):
+                    print refdes, method, stream
+                    resolve_stream.resolve_stream(refdes, method, stream, stream_map, m2m)
+                    resolved += 1
+    sys.stderr.write('Resolved %d streams\n' % resolved)
+
+
+def report(results):
+    print '%-18s %6s %10s %10s %12s %6s' % ('tool', 'scale', 'seconds', 'growth', 'peak RSS kB', 'status')
+    previous = {}
+    for result in results:
+        growth = ''
+        last = previous.get(result['tool'])
+        if last is not None and last['seconds'] > 0:
+            growth = '%.2f' % ((result['seconds'] / last['seconds']) / (float(result['scale']) / last['scale']))
+        previous[result['tool']] = result
+        print '%-18s %6d %10.3f %10s %12d %6d' % (result['tool'], result['scale'], result['seconds'], growth,
+                                                  result['peak_rss_kb'], result['status'])
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['--worker']:
+        worker(int(options['<scale>']))
+        return
+
+    scales = [int(scale) for scale in options['--scales'].split(',')]
+    tools = options['--tools'].split(',')
+    for tool in tools:
+        if tool not in ('validate_preload', 'load_preload', 'generate_cql', 'resolve_stream'):
+            raise docopt.DocoptExit('Unknown tool: %s' % tool)
+
+    base_dir = options['--keep'] or tempfile.mkdtemp()
+    results = []
+    try:
+        for scale in scales:
+            work_dir = os.path.join(base_dir, 'scale_%d' % scale)
+            os.makedirs(work_dir)
+            prepare(work_dir, scale)
+            for tool in tools:
+                results.append(run_tool(tool, work_dir, scale))
+                sys.stderr.write('%(tool)s at %(scale)dx: %(seconds).3fs, %(peak_rss_kb)d kB\n' % results[-1])
+    finally:
+        if not options['--keep']:
+            shutil.rmtree(base_dir)
+
+    results.sort(key=lambda result: (tools.index(result['tool']), result['scale']))
+    report(results)
+    if options['--output']:
+        with open(options['--output'], 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Usage:
+    shared_engine.py [--processes=<n>]
+    shared_engine.py --worker (memory|shared)
+
+Options:
+    --processes=<n>  Number of concurrent worker processes per mode [default: 4]
+
+    Compare the private in-memory preload database against the shared read-only
+    memory-mapped database. For each mode the given number of worker processes
+    open the preload database and load every stream and parameter through the ORM,
+    then report their startup time, resident set size (RSS) and proportional set
+    size (PSS, shared pages divided between the processes mapping them).
+"""
+import os
+import subprocess
+import sys
+import time
+
+import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def worker(shared):
+    start = time.time()
+
+    import database
+    from ooi_data.postgres.model import Parameter, Stream
+
+    engine = database.create_engine_from_url(None, shared=shared)
+    session = database.create_scoped_session(engine)
+    for stream in session.query(Stream):
+        stream.parameters
+    session.query(Parameter).all()
+
+    sys.stdout.write('%f\n' % (time.time() - start))
+    sys.stdout.flush()
+    # block until the parent process has measured our memory usage
+    sys.stdin.readline()
+
+
+def read_memory(pid):
+    """Return (rss, pss) in kB for the given process, pss is None if the kernel does not report it"""
+    rss = pss = None
+    with open('/proc/%d/status' % pid) as fh:
+        for line in fh:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    rollup = '/proc/%d/smaps_rollup' % pid
+    if os.path.exists(rollup):
+        with open(rollup) as fh:
+            for line in fh:
+                if line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+    return rss, pss
+
+
+def run(mode, processes):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode]
+    workers = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE) for _ in range(processes)]
+
+    # wait until every worker is holding its database open before measuring
+    startup = [float(each.stdout.readline()) for each in workers]
+    memory = [read_memory(each.pid) for each in workers]
+
+    for each in workers:
+        each.communicate(b'\n')
+
+    rss = [m[0] for m in memory]
+    pss = [m[1] for m in memory if m[1] is not None]
+    print '%-8s startup mean %6.3fs max %6.3fs  RSS mean %8d kB  PSS mean %s' % (
+        mode, sum(startup) / len(startup), max(startup), sum(rss) / len(rss),
+        '%8d kB' % (sum(pss) / len(pss)) if pss else 'n/a')
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    if options['--worker']:
+        worker(options['shared'])
+        return
+
+    processes = int(options['--processes'])
+    # make sure the snapshot exists so neither mode pays for building it
+    import database
+    database.get_preload_database_snapshot()
+
+    print 'Workers per mode: %d' % processes
+    for mode in ['memory', 'shared']:
+        run(mode, processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Usage:
+    synthetic_catalog.py [--scale=<n>] <dir>
+
+Options:
+    --scale=<n>  Number of copies of the current catalog to write [default: 10]
+
+    Write a synthetic preload catalog of n times the size of the current one to
+    <dir>: ParameterDefs.csv, ParameterFunctions.csv, ParameterDictionary.csv,
+    BinSizes.csv and nominal_depths.csv.
+
+    Each copy of the catalog is the current catalog with its PD, PFID and DICT
+    ids shifted past those of the previous copies, and its stream names and
+    reference designator subsites suffixed with the copy number. Function maps,
+    parameter lists, temporal parameters and stream dependencies are rewritten
+    to the ids of the same copy, so every copy has the structure of the current
+    catalog. The temporal parameters (time) are shared by every copy, as they
+    are by every stream now. Data product identifiers are left as they are, so
+    as the catalog grows more parameters supply each data product, as new
+    instruments would.
+"""
+import os
+import sys
+
+import docopt
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from validate_preload import TEMPORAL_PARAMETERS
+
+CSV_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'csv')
+
+# Columns of each CSV file holding ids, by id prefix
+ID_COLUMNS = {
+    'ParameterDefs': {'PD': ['id', 'parameterfunctionmap'], 'PFID': ['parameterfunctionid']},
+    'ParameterFunctions': {'PFID': ['id']},
+    'ParameterDictionary': {'DICT': ['id', 'streamdependency'], 'PD': ['parameterids', 'temporalparameter']},
+    'BinSizes': {},
+    'nominal_depths': {},
+}
+
+
+def read_csv(csv_dir, csv_file):
+    # Every column as text, missing values as empty strings, so the rows are written back unchanged
+    return pd.read_csv(os.path.join(csv_dir, '%s.csv' % csv_file), dtype=str, keep_default_na=False,
+                       encoding='utf-8')
+
+
+def id_offset(frames, prefix):
+    # Smallest power of ten above every id with prefix, copies of the catalog are that far apart
+    pattern = r'\b%s(\d+)\b' % prefix
+    largest = max(int(value) for csv_file, frame in frames.items()
+                  for column in ID_COLUMNS[csv_file].get(prefix, [])
+                  for value in frame[column].str.extractall(pattern)[0].unique())
+    return 10 ** len(str(largest))
+
+
+def shift_ids(column, prefix, offset):
+    # Add offset to every id with prefix, except the shared temporal parameters
+    def shift(match):
+        if match.group(0) in TEMPORAL_PARAMETERS:
+            return match.group(0)
+        return '%s%d' % (prefix, int(match.group(1)) + offset)
+    return column.str.replace(r'\b%s(\d+)\b' % prefix, shift)
+
+
+def copy_name(name, copy):
+    return name if copy == 0 else '%s_x%d' % (name, copy)
+
+
+def copy_designator(designator, copy):
+    if copy == 0:
+        return designator
+    subsite, _, rest = designator.partition('-')
+    return '%sX%d-%s' % (subsite, copy, rest)
+
+
+def copy_frame(csv_file, frame, copy, offsets):
+    """Rows of copy number copy of a CSV file, the DOC rows and shared parameters are only in the first"""
+    if copy == 0:
+        return frame
+    if 'scenario' in frame:
+        frame = frame[~frame.scenario.str.startswith('DOC')]
+    if csv_file == 'ParameterDefs':
+        frame = frame[~frame.id.isin(TEMPORAL_PARAMETERS)]
+    frame = frame.copy()
+    for prefix, columns in ID_COLUMNS[csv_file].items():
+        for column in columns:
+            frame[column] = shift_ids(frame[column], prefix, copy * offsets[prefix])
+    if csv_file == 'ParameterDictionary':
+        frame['name'] = frame.name.map(lambda name: copy_name(name, copy))
+    elif csv_file == 'BinSizes':
+        frame['stream'] = frame.stream.map(lambda name: copy_name(name, copy))
+    elif csv_file == 'nominal_depths':
+        frame['designator'] = frame.designator.map(lambda designator: copy_designator(designator, copy))
+    return frame
+
+
+def generate(output_dir, scale, csv_dir=CSV_DIR):
+    """Write a catalog of scale copies of the CSV files in csv_dir to output_dir"""
+    frames = {csv_file: read_csv(csv_dir, csv_file) for csv_file in ID_COLUMNS}
+    offsets = {prefix: id_offset(frames, prefix) for prefix in ['PD', 'PFID', 'DICT']}
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for csv_file, frame in frames.items():
+        data = pd.concat([copy_frame(csv_file, frame, copy, offsets) for copy in range(scale)])
+        data.to_csv(os.path.join(output_dir, '%s.csv' % csv_file), index=False, encoding='utf-8')
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    generate(options['<dir>'], int(options['--scale']))
+
+
+if __name__ == '__main__':
+    main()
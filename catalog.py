@@ -0,0 +1,373 @@
+"""
+Read-only, in-process view of the preload catalog.
+
+PreloadCatalog reads the preload tables once with plain SQL and links the rows into a
+graph of __slots__ objects indexed by id, name and data product identifier. Read-only
+tools can then walk streams, parameters and their dependencies without a query per
+relationship. The objects provide the attributes of the ooi_data models used by the
+tools (is_function, needs, needs_cc, parameters, streams, ...).
+"""
+import json
+from collections import Mapping
+from numbers import Number
+from operator import attrgetter
+
+import database
+
+VALUE_TABLES = ['code_set', 'data_product_type', 'dimension', 'fill_value', 'function_type',
+                'parameter_type', 'stream_content', 'stream_type', 'unit', 'value_encoding']
+
+by_id = attrgetter('id')
+
+
+class FrozenDict(Mapping):
+    """Read-only view of a dict"""
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'FrozenDict(%r)' % (self._data,)
+
+
+def fetch_dict(bind, sql):
+    # Rows of a two column query as a dict, a ResultProxy has keys() so dict() would treat it as a mapping
+    return dict(tuple(row) for row in bind.execute(sql))
+
+
+class CatalogParameter(object):
+    __slots__ = ('id', 'name', 'netcdf_name', 'display_name', 'standard_name', 'description',
+                 'parameter_type', 'value_encoding', 'code_set', 'unit', 'fill_value', 'data_product_type',
+                 'precision', 'data_level', 'visible', 'data_product_identifier', 'parameter_function_id',
+                 'parameter_function', 'parameter_function_map', 'dimensions', 'streams', 'needs', 'needs_cc')
+
+    @property
+    def is_function(self):
+        return self.parameter_type == 'function'
+
+    @property
+    def is_l1(self):
+        return self.data_level == 1
+
+    @property
+    def is_l2(self):
+        return self.data_level == 2
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+    def __repr__(self):
+        return '<Parameter PD%d %s>' % (self.id, self.name)
+
+
+class CatalogStream(object):
+    __slots__ = ('id', 'name', 'time_parameter', 'binsize_minutes', 'stream_type', 'stream_content',
+                 'parameters', 'source_streams', 'product_streams')
+
+    @property
+    def derived(self):
+        return [p for p in self.parameters if p.is_function]
+
+    @property
+    def needs(self):
+        return self.needs_external(self.derived)
+
+    @property
+    def needs_cc(self):
+        needs = set()
+        for p in self.derived:
+            needs.update(p.needs_cc)
+        return needs
+
+    def _local(self, stream, poss_params):
+        # parameters from poss_params this stream provides, if the need may be met by this stream
+        if stream is None or stream is self:
+            return [p for p in poss_params if p in self.parameters]
+        return []
+
+    def needs_external(self, parameters):
+        """Return the set of (stream, possible parameters) needed by parameters which this stream cannot provide"""
+        external = set()
+        visited = set()
+        to_visit = [p for p in parameters if p.is_function]
+        while to_visit:
+            parameter = to_visit.pop()
+            if parameter in visited:
+                continue
+            visited.add(parameter)
+            for stream, poss_params in parameter.needs:
+                local = self._local(stream, poss_params)
+                if local:
+                    to_visit.extend(p for p in local if p.is_function)
+                else:
+                    external.add((stream, poss_params))
+        return external
+
+    def needs_internal(self, parameters):
+        """Return the set of non-function parameters from this stream required to compute parameters"""
+        internal = set()
+        visited = set()
+        to_visit = list(parameters)
+        while to_visit:
+            parameter = to_visit.pop()
+            if parameter in visited:
+                continue
+            visited.add(parameter)
+            if not parameter.is_function:
+                internal.add(parameter)
+                continue
+            for stream, poss_params in parameter.needs:
+                to_visit.extend(self._local(stream, poss_params))
+        return internal
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+    def __repr__(self):
+        return '<Stream DICT%d %s>' % (self.id, self.name)
+
+
+class CatalogFunction(object):
+    __slots__ = ('id', 'name', 'function_type', 'function', 'owner', 'description', 'qc_flag')
+
+    def __repr__(self):
+        return '<ParameterFunction PFID%d %s>' % (self.id, self.name)
+
+
+class CatalogNominalDepth(object):
+    __slots__ = ('id', 'subsite', 'node', 'sensor', 'depth', 'same_subsite')
+
+    @property
+    def reference_designator(self):
+        return '-'.join((self.subsite, self.node, self.sensor))
+
+    def get_colocated_subsite(self):
+        return [nd for nd in self.same_subsite if nd.depth == self.depth]
+
+    def get_colocated_node(self):
+        return [nd for nd in self.same_subsite if nd.node == self.node]
+
+    def get_depth_within(self, meters):
+        if self.depth is None:
+            return []
+        return [nd for nd in self.same_subsite
+                if nd.depth is not None and self.depth - meters <= nd.depth <= self.depth + meters]
+
+    def __repr__(self):
+        return '<NominalDepth %s %r>' % (self.reference_designator, self.depth)
+
+
+class PreloadCatalog(object):
+    """
+    Immutable graph of the preload catalog built from a single pass over the database.
+
+    The indexes are read-only FrozenDict views and the related objects of each object are tuples.
+
+    :param bind: SQLAlchemy engine or connection (or a raw DB-API connection) to read from
+    """
+    __slots__ = ('parameters', 'streams', 'functions', 'units', 'nominal_depths',
+                 'parameters_by_name', 'parameters_by_dpi', 'streams_by_name', 'nominal_depths_by_refdes')
+
+    def __init__(self, bind):
+        values = {table: fetch_dict(bind, 'SELECT id, value FROM %s' % table) for table in VALUE_TABLES}
+        self.units = values['unit']
+
+        self.functions = {}
+        for row in bind.execute('SELECT id, name, function_type_id, function, owner, description, qc_flag '
+                                'FROM parameter_function'):
+            func = CatalogFunction()
+            func.id, func.name, function_type_id, func.function, func.owner, func.description, func.qc_flag = row
+            func.function_type = values['function_type'].get(function_type_id)
+            self.functions[func.id] = func
+
+        self._load_parameters(bind, values)
+        self._load_streams(bind, values)
+        self._load_nominal_depths(bind)
+
+        for parameter in self.parameters.values():
+            self._link_needs(parameter)
+
+        for name in self.__slots__:
+            setattr(self, name, FrozenDict(getattr(self, name)))
+
+    def _load_parameters(self, bind, values):
+        self.parameters = {}
+        self.parameters_by_name = {}
+        self.parameters_by_dpi = {}
+        for row in bind.execute('SELECT id, name, netcdf_name, display_name, standard_name, description, '
+                                'parameter_type_id, value_encoding_id, code_set_id, unit_id, fill_value_id, '
+                                'data_product_type_id, precision, data_level, visible, data_product_identifier, '
+                                'parameter_function_id, parameter_function_map FROM parameter ORDER BY id'):
+            p = CatalogParameter()
+            (p.id, p.name, p.netcdf_name, p.display_name, p.standard_name, p.description,
+             parameter_type_id, value_encoding_id, code_set_id, unit_id, fill_value_id,
+             data_product_type_id, p.precision, p.data_level, visible, p.data_product_identifier,
+             p.parameter_function_id, pmap) = row
+            p.parameter_type = values['parameter_type'].get(parameter_type_id)
+            p.value_encoding = values['value_encoding'].get(value_encoding_id)
+            p.code_set = values['code_set'].get(code_set_id)
+            p.unit = values['unit'].get(unit_id)
+            p.fill_value = values['fill_value'].get(fill_value_id)
+            p.data_product_type = values['data_product_type'].get(data_product_type_id)
+            p.visible = bool(visible) if visible is not None else None
+            p.parameter_function = self.functions.get(p.parameter_function_id)
+            # sqlite stores the map as JSON text, postgres returns it decoded
+            p.parameter_function_map = pmap if pmap is None or isinstance(pmap, dict) else json.loads(pmap)
+            p.dimensions = []
+            p.streams = []
+            self.parameters[p.id] = p
+            self.parameters_by_name.setdefault(p.name, []).append(p)
+            if p.data_product_identifier:
+                self.parameters_by_dpi.setdefault(p.data_product_identifier, []).append(p)
+
+        for parameter_id, dimension_id in bind.execute('SELECT parameter_id, dimension_id FROM parameter_dimension '
+                                                       'ORDER BY parameter_id, dimension_id'):
+            p = self.parameters.get(parameter_id)
+            if p is not None:
+                p.dimensions.append(values['dimension'].get(dimension_id))
+
+        for p in self.parameters.values():
+            p.dimensions = tuple(p.dimensions)
+        self.parameters_by_name = {k: tuple(v) for k, v in self.parameters_by_name.items()}
+        self.parameters_by_dpi = {k: tuple(v) for k, v in self.parameters_by_dpi.items()}
+
+    def _load_streams(self, bind, values):
+        self.streams = {}
+        for row in bind.execute('SELECT id, name, time_parameter, binsize_minutes, stream_type_id, '
+                                'stream_content_id FROM stream ORDER BY id'):
+            s = CatalogStream()
+            s.id, s.name, s.time_parameter, s.binsize_minutes, stream_type_id, stream_content_id = row
+            s.stream_type = values['stream_type'].get(stream_type_id)
+            s.stream_content = values['stream_content'].get(stream_content_id)
+            s.parameters = []
+            s.source_streams = []
+            s.product_streams = []
+            self.streams[s.id] = s
+        self.streams_by_name = {s.name: s for s in self.streams.values()}
+
+        for stream_id, parameter_id in bind.execute('SELECT stream_id, parameter_id FROM stream_parameter '
+                                                    'ORDER BY stream_id, parameter_id'):
+            s = self.streams.get(stream_id)
+            p = self.parameters.get(parameter_id)
+            if s is not None and p is not None:
+                s.parameters.append(p)
+                p.streams.append(s)
+
+        for source_id, product_id in bind.execute('SELECT source_stream_id, product_stream_id '
+                                                  'FROM stream_dependency ORDER BY source_stream_id, product_stream_id'):
+            source = self.streams.get(source_id)
+            product = self.streams.get(product_id)
+            if source is not None and product is not None:
+                product.source_streams.append(source)
+                source.product_streams.append(product)
+
+        for s in self.streams.values():
+            s.parameters = tuple(s.parameters)
+            s.source_streams = tuple(s.source_streams)
+            s.product_streams = tuple(s.product_streams)
+        for p in self.parameters.values():
+            p.streams = tuple(p.streams)
+
+    def _load_nominal_depths(self, bind):
+        self.nominal_depths = {}
+        by_subsite = {}
+        for row in bind.execute('SELECT id, subsite, node, sensor, depth FROM nominal_depth ORDER BY id'):
+            nd = CatalogNominalDepth()
+            nd.id, nd.subsite, nd.node, nd.sensor, nd.depth = row
+            self.nominal_depths[nd.id] = nd
+            by_subsite.setdefault(nd.subsite, []).append(nd)
+
+        for same_subsite in by_subsite.values():
+            same_subsite = tuple(same_subsite)
+            for nd in same_subsite:
+                nd.same_subsite = same_subsite
+        self.nominal_depths_by_refdes = {nd.reference_designator: nd for nd in self.nominal_depths.values()}
+
+    def _resolve(self, value):
+        """Return the (stream, possible parameters) referred to by a parameter function map value"""
+        if value.startswith('dpi_'):
+            return None, self.parameters_by_dpi.get(value[4:], ())
+
+        stream = None
+        if '.PD' in value:
+            stream_name, value = value.split('.', 1)
+            stream = self.streams_by_name.get(stream_name)
+
+        if value.startswith('PD'):
+            try:
+                parameter = self.parameters.get(int(value[2:]))
+            except ValueError:
+                parameter = None
+            if parameter is not None:
+                return stream, (parameter,)
+        return stream, ()
+
+    def _link_needs(self, parameter):
+        needs = []
+        needs_cc = []
+        pmap = parameter.parameter_function_map
+        if parameter.is_function and isinstance(pmap, dict):
+            for key in sorted(pmap):
+                value = pmap[key]
+                if isinstance(value, Number):
+                    continue
+                if isinstance(value, list):
+                    # any one of several parameters satisfies this argument
+                    poss_params = set()
+                    for each in value:
+                        if not isinstance(each, Number):
+                            poss_params.update(self._resolve(each)[1])
+                    if poss_params:
+                        needs.append((None, tuple(sorted(poss_params, key=by_id))))
+                elif value.startswith('CC'):
+                    needs_cc.append(value)
+                else:
+                    stream, poss_params = self._resolve(value)
+                    if poss_params:
+                        needs.append((stream, poss_params))
+        parameter.needs = tuple(needs)
+        parameter.needs_cc = tuple(needs_cc)
+
+    def get_parameter(self, parameter_id):
+        return self.parameters.get(parameter_id)
+
+    def get_stream(self, stream_id):
+        return self.streams.get(stream_id)
+
+    def get_stream_by_name(self, name):
+        return self.streams_by_name.get(name)
+
+    def get_parameters_by_name(self, name):
+        return self.parameters_by_name.get(name, ())
+
+    def get_parameters_by_dpi(self, dpi):
+        return self.parameters_by_dpi.get(dpi, ())
+
+    def get_nominal_depth(self, subsite, node, sensor):
+        return self.nominal_depths_by_refdes.get('-'.join((subsite, node, sensor)))
+
+
+def create_catalog(url=None, tables=None, timing=None):
+    """
+    Build a PreloadCatalog from the database at url, or from preload_database.sql if url is None.
+
+    :param tables: preload tables to load when building from preload_database.sql, None for all
+    :param timing: see database.get_startup_timing
+    """
+    timing = database.get_startup_timing(timing)
+    engine = database.create_engine_from_url(url, tables=tables, timing=timing)
+    try:
+        with database.timed_phase(timing, 'build_catalog'):
+            return PreloadCatalog(engine)
+    finally:
+        engine.dispose()
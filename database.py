@@ -1,55 +1,544 @@
+import glob
+import gzip
+import hashlib
+import json
+import logging
 import os
+import re
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 from ooi_data.postgres.model import MetadataBase
 from ooi_data.postgres.model.preload import preload_tables
+from sqlalchemy import Column, MetaData, String, Table
 from sqlalchemy import create_engine
+from sqlalchemy.orm import configure_mappers
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
+log = logging.getLogger(__name__)
+
 here = os.path.abspath(os.path.dirname(__file__))
 
-PRELOAD_DATABASE_SCRIPT_FILE_PATH = os.path.join(here, "preload_database.sql")
+# Set PRELOAD_DATABASE_SCRIPT to read and write the preload database script at another path
+PRELOAD_DATABASE_SCRIPT_FILE_PATH = os.environ.get('PRELOAD_DATABASE_SCRIPT', os.path.join(here, "preload_database.sql"))
+PRELOAD_DATABASE_CACHE_DIR = os.environ.get('PRELOAD_CACHE_DIR', os.path.join(here, '.preload_cache'))
+PRELOAD_DATABASE_SNAPSHOT_PREFIX = 'preload_database_'
+PRELOAD_DATABASE_MMAP_SIZE = 256 * 1024 * 1024
+PRELOAD_DATABASE_INSERT_BATCH_SIZE = 500
+# Set to 1 to write startup phase timings to stderr, or to a file path to append them to that file
+PRELOAD_TIMING = os.environ.get('PRELOAD_TIMING')
+
+# Suffix of the preload database script for each supported compression, in order of preference when loading
+PRELOAD_DATABASE_COMPRESSION = [
+    (None, ''),
+    ('gzip', '.gz'),
+    ('xz', '.xz'),
+]
+
+# Secondary indexes for the lookups made by the preload tools. Stream.name and the
+# nominal_depth (subsite, node, sensor) lookups are covered by their unique constraints.
+PRELOAD_INDEXES = [
+    ('ix_parameter_name', 'parameter', ('name',)),
+    ('ix_parameter_data_product_identifier', 'parameter', ('data_product_identifier',)),
+    ('ix_stream_parameter_parameter_id', 'stream_parameter', ('parameter_id',)),
+    ('ix_stream_dependency_product_stream_id', 'stream_dependency', ('product_stream_id',)),
+    ('ix_nominal_depth_subsite_depth', 'nominal_depth', ('subsite', 'depth')),
+]
+
+# Content hashes of the CSV rows applied by load_preload.py, used to skip unchanged rows on the next run.
+# This is loader bookkeeping, not preload, so it is not written to preload_database.sql.
+preload_row_hash = Table(
+    'preload_row_hash', MetaData(),
+    Column('source', String(64), primary_key=True),
+    Column('key', String(250), primary_key=True),
+    Column('hash', String(40), nullable=False),
+)
+PRELOAD_DATABASE_EXCLUDED_TABLES = {preload_row_hash.name}
+
+STATEMENT_TABLE_PATTERN = re.compile(r'(?:CREATE TABLE|INSERT INTO|CREATE (?:UNIQUE )?INDEX \w+ ON) "?(\w+)"?')
+TRANSACTION_PATTERN = re.compile(r'(?:BEGIN|COMMIT|END)\b')
+
+# Engines created by get_engine, keyed by their arguments, with the pid of the process that created them
+_engines = {}
+_engines_lock = threading.Lock()
+# Engines inherited from the parent process after a fork. They are kept referenced and never disposed
+# in the child so their pooled connections are not closed (or garbage collected) out from under the parent.
+_inherited_engines = []
+
+
+class StartupTiming(object):
+    """
+    Record the wall time, CPU time and peak resident set size of each preload startup phase.
+
+    Each phase is written to output (a file object or the path of a file to append to) as a single
+    line of JSON when it completes. Peak RSS can only grow, so peak_rss_growth_kb is the amount
+    a phase raised the high water mark of the process.
+    """
+    def __init__(self, output=None):
+        self.output = output
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, **fields):
+        start_cpu, start_rss = get_resource_usage()
+        start = time.time()
+        try:
+            yield
+        finally:
+            cpu, peak_rss = get_resource_usage()
+            record = {
+                'phase': name,
+                'seconds': round(time.time() - start, 6),
+                'cpu_seconds': round(cpu - start_cpu, 6),
+                'peak_rss_kb': peak_rss,
+                'peak_rss_growth_kb': peak_rss - start_rss,
+            }
+            record.update(fields)
+            self.phases.append(record)
+            self.write(record)
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        if hasattr(self.output, 'write'):
+            self.output.write(line)
+            self.output.flush()
+        elif self.output is not None:
+            with open(self.output, 'a') as fh:
+                fh.write(line)
+
+
+def get_resource_usage():
+    """Return (CPU seconds, peak RSS in kB) for this process"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is reported in kilobytes on Linux and bytes on OS X
+    peak_rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return usage.ru_utime + usage.ru_stime, peak_rss
+
+
+def get_startup_timing(timing=None):
+    """
+    Resolve the timing argument of the engine and session factories.
+
+    :param timing: a StartupTiming, True to write to stderr, or None to follow the PRELOAD_TIMING
+                   environment variable. Returns None when timing is disabled.
+    """
+    if timing is None and PRELOAD_TIMING:
+        timing = True if PRELOAD_TIMING in ('1', 'stderr') else StartupTiming(PRELOAD_TIMING)
+    if timing is True:
+        timing = StartupTiming(sys.stderr)
+    return timing or None
+
+
+@contextmanager
+def timed_phase(timing, name, **fields):
+    if timing is None:
+        yield
+    else:
+        with timing.phase(name, **fields):
+            yield
+
 
+def create_in_memory_engine(tables=None, timing=None):
+    """
+    Create an in-memory SQLite engine populated with the preload database.
 
-def create_in_memory_engine():
-    engine = create_engine('sqlite://')
-    engine.connect()
-    script = get_preload_database_script_as_string()
-    if script:
+    :param tables: names of the tables whose rows are needed, or None for all tables. The schema
+                   is always created for every table so unused relationships simply load nothing.
+    :param timing: see get_startup_timing
+    """
+    timing = get_startup_timing(timing)
+    with timed_phase(timing, 'create_engine'):
+        engine = create_engine('sqlite://')
+        engine.connect()
         sqlite_connection = engine.raw_connection().connection
-        sqlite_connection.executescript(script)
-        sqlite_connection.commit()
+    with timed_phase(timing, 'get_snapshot'):
+        snapshot = get_preload_database_snapshot()
+    if snapshot:
+        with timed_phase(timing, 'copy_snapshot', tables=tables):
+            copy_snapshot(snapshot, sqlite_connection, tables)
+        return engine
+
+    if get_preload_database_script_path():
+        with timed_phase(timing, 'load_script', tables=tables):
+            load_preload_database_script(sqlite_connection, tables)
     else:
-        MetadataBase.metadata.create_all(bind=engine, tables=preload_tables)
+        with timed_phase(timing, 'create_schema'):
+            MetadataBase.metadata.create_all(bind=engine, tables=preload_tables)
+            create_preload_indexes(engine)
     return engine
 
 
-def create_scoped_session(engine):
+def create_shared_engine(path=None):
+    """
+    Create an engine over a prebuilt preload SQLite file opened read-only with a large mmap_size.
+
+    All processes on a host opening the same file share one page-cache copy of the catalog instead of
+    each holding a private in-memory database. Defaults to the snapshot of preload_database.sql.
+    """
+    if path is None:
+        path = get_preload_database_snapshot()
+        if path is None:
+            raise IOError('No preload database script available at %s' % PRELOAD_DATABASE_SCRIPT_FILE_PATH)
+
+    return create_engine('sqlite://', creator=lambda: connect_read_only(path))
+
+
+def sqlite_uri_filenames():
+    # Whether the SQLite library interprets file: URIs in every filename (built with SQLITE_USE_URI)
+    options = {row[0] for row in sqlite3.connect(':memory:').execute('PRAGMA compile_options')}
+    return bool(options.intersection({'USE_URI', 'USE_URI=1'}))
+
+
+def connect_read_only(path):
+    """
+    Open the SQLite file at path read-only and immutable, so it is never locked or checked for changes.
+
+    Python 2's sqlite3 cannot ask for URI filenames, but a SQLite library built with SQLITE_USE_URI
+    (as most distributions build it) interprets them anyway. Otherwise the file is opened with
+    PRAGMA query_only, which is neither immutable nor enforced, and a warning is logged.
+    """
+    uri = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(path))
+    try:
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    except TypeError:
+        if sqlite_uri_filenames():
+            connection = sqlite3.connect(uri, check_same_thread=False)
+        else:
+            log.warning('SQLite %s does not accept URI filenames, opening %s query-only rather than immutable',
+                        sqlite3.sqlite_version, path)
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute('PRAGMA query_only = 1')
+    connection.execute('PRAGMA mmap_size = %d' % PRELOAD_DATABASE_MMAP_SIZE)
+    return connection
+
+
+def create_scoped_session(engine, timing=None):
+    timing = get_startup_timing(timing)
+    if timing is not None:
+        # mappers are otherwise configured by the first query, configure them now so they are timed separately
+        with timing.phase('configure_mappers'):
+            configure_mappers()
     return scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
 
-def create_engine_from_url(url):
+def create_engine_from_url(url, shared=False, tables=None, timing=None):
     if url is None:
-        return create_in_memory_engine()
+        if shared:
+            return create_shared_engine()
+        return create_in_memory_engine(tables, timing)
     return create_engine(url)
 
 
-def generate_script_from_preload_database(connection):
+def get_engine(url=None, shared=False, tables=None):
+    """
+    Return an engine private to the calling process, creating it on first use in each process.
+
+    Engines (and their connections) are never shared across a fork: a child process gets a new engine
+    the first time it asks for one, either opening the shared read-only snapshot (shared=True) or
+    copying the snapshot into its own in-memory database. Arguments are as for create_engine_from_url.
+    """
+    key = (url, shared, tuple(sorted(tables)) if tables is not None else None)
+    pid = os.getpid()
+    with _engines_lock:
+        entry = _engines.get(key)
+        if entry is None or entry[0] != pid:
+            if entry is not None:
+                _inherited_engines.append(entry[1])
+            entry = _engines[key] = (pid, create_engine_from_url(url, shared=shared, tables=tables))
+        return entry[1]
+
+
+def create_process_scoped_session(url=None, shared=False, tables=None):
+    """
+    Create a scoped_session whose sessions are private to each process and thread.
+
+    Unlike create_scoped_session no engine is created up front, each process binds its sessions
+    to the engine returned by get_engine, so this is safe to call at import time in code that
+    is later run under multiprocessing or a pre-fork server.
+    """
+    factory = sessionmaker(autocommit=False, autoflush=False)
+
+    def create_session():
+        return factory(bind=get_engine(url, shared=shared, tables=tables))
+
+    def scope():
+        return os.getpid(), threading.current_thread().ident
+
+    return scoped_session(create_session, scopefunc=scope)
+
+
+def create_preload_indexes(bind):
+    # Works with an SQLAlchemy engine or connection as well as a raw sqlite3 connection
+    for name, table, columns in PRELOAD_INDEXES:
+        bind.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, ', '.join(columns)))
+
+
+def generate_script_from_preload_database(connection, compact=True, compression=None):
     delete_preload_database_script()
     # Dump the SQLite database to a script
-    with open(PRELOAD_DATABASE_SCRIPT_FILE_PATH, "w") as sqlFile:
-        for line in connection.iterdump():
+    dump = iter_compact_dump(connection) if compact else connection.iterdump()
+    dump = (line for line in dump if get_statement_table(line) not in PRELOAD_DATABASE_EXCLUDED_TABLES)
+    path = PRELOAD_DATABASE_SCRIPT_FILE_PATH + dict(PRELOAD_DATABASE_COMPRESSION)[compression]
+    with open_preload_database_script(path, 'w') as sqlFile:
+        for line in dump:
             sqlFile.write((line + '\n').encode('utf8'))
 
 
+def open_preload_database_script(path, mode='r'):
+    """Open the preload database script at path, compressed according to its suffix, for reading or writing"""
+    if path.endswith('.gz'):
+        # fix the header timestamp so identical scripts produce identical artifacts
+        return gzip.GzipFile(path, mode + 'b', mtime=0)
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('xz compression requires the lzma module (backports.lzma on Python 2): %s' % path)
+        return lzma.LZMAFile(path, mode + 'b')
+    return open(path, mode)
+
+
+def iter_compact_dump(connection, batch_size=PRELOAD_DATABASE_INSERT_BATCH_SIZE):
+    """
+    Dump an SQLite database as SQL statements using multi-row INSERTs of up to batch_size rows.
+
+    Tables are dumped in name order and rows in primary key order, one row per line, so the
+    output is stable and diffs between versions only show changed rows. Indexes are created
+    after all of the rows have been inserted.
+    """
+    yield 'BEGIN TRANSACTION;'
+    tables = connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                                "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+    for name, sql in tables:
+        yield '%s;' % sql
+
+        # PRAGMA table_info rows are (cid, name, type, notnull, default, pk position)
+        info = connection.execute('PRAGMA table_info("%s")' % name).fetchall()
+        columns = ['quote("%s")' % row[1] for row in info]
+        order = ['"%s"' % row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]] or ['rowid']
+        rows = connection.execute('SELECT %s FROM "%s" ORDER BY %s' % (" || ',' || ".join(columns),
+                                                                        name, ', '.join(order)))
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+            yield 'INSERT INTO "%s" VALUES\n%s;' % (name, ',\n'.join('(%s)' % row for row, in batch))
+
+    for sql, in connection.execute("SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger', 'view') "
+                                   "AND sql IS NOT NULL ORDER BY type, name"):
+        yield '%s;' % sql
+    yield 'COMMIT;'
+
+
 def delete_preload_database_script():
-    # Delete the preload database script if it exists
-    if os.path.isfile(PRELOAD_DATABASE_SCRIPT_FILE_PATH):
-        os.remove(PRELOAD_DATABASE_SCRIPT_FILE_PATH)
+    # Delete the preload database script, and any compressed copies, if they exist
+    for _, suffix in PRELOAD_DATABASE_COMPRESSION:
+        if os.path.isfile(PRELOAD_DATABASE_SCRIPT_FILE_PATH + suffix):
+            os.remove(PRELOAD_DATABASE_SCRIPT_FILE_PATH + suffix)
+
+
+def get_preload_database_script_path():
+    # Path to the preload database script, preferring the uncompressed script if there is more than one
+    for _, suffix in PRELOAD_DATABASE_COMPRESSION:
+        if os.path.isfile(PRELOAD_DATABASE_SCRIPT_FILE_PATH + suffix):
+            return PRELOAD_DATABASE_SCRIPT_FILE_PATH + suffix
 
 
-def get_preload_database_script_as_string():
-    # Read the entire SQL script into a string
-    if os.path.exists(PRELOAD_DATABASE_SCRIPT_FILE_PATH):
-        with open(PRELOAD_DATABASE_SCRIPT_FILE_PATH, "r") as sqlFile:
+def get_preload_database_script_as_string(tables=None):
+    path = get_preload_database_script_path()
+    if path is None:
+        return None
+
+    if tables is None:
+        # Read the entire SQL script into a string
+        with open_preload_database_script(path) as sqlFile:
             return sqlFile.read()
+
+    return ''.join(iter_preload_database_script_statements(tables))
+
+
+def load_preload_database_script(connection, tables=None):
+    """
+    Execute the preload database script against an sqlite3 connection.
+
+    Statements are streamed from the (possibly compressed) script and executed one at a time
+    so the plaintext of the script is never held in memory.
+    """
+    for statement in iter_preload_database_script_statements(tables):
+        # let the sqlite3 module manage the transaction
+        if not TRANSACTION_PATTERN.match(statement):
+            connection.execute(statement)
+    connection.commit()
+
+
+def iter_preload_database_script_statements(tables=None):
+    """
+    Yield each complete statement in the preload database script without reading the whole file into memory.
+
+    :param tables: if not None only yield the rows and indexes of these tables. Every CREATE TABLE is
+                   still yielded so the schema is complete.
+    """
+    for statement in iter_script_statements(get_preload_database_script_path()):
+        if tables is not None and not statement.startswith('CREATE TABLE'):
+            table = get_statement_table(statement)
+            if table is not None and table not in tables:
+                continue
+        yield statement
+
+
+def iter_script_statements(path):
+    with open_preload_database_script(path) as sqlFile:
+        lines = []
+        for line in sqlFile:
+            lines.append(line)
+            if line.rstrip().endswith(';'):
+                statement = ''.join(lines)
+                if sqlite3.complete_statement(statement):
+                    yield statement
+                    lines = []
+        if lines:
+            yield ''.join(lines)
+
+
+def get_statement_table(statement):
+    # Name of the table a CREATE TABLE, INSERT or CREATE INDEX statement applies to, None for anything else
+    match = STATEMENT_TABLE_PATTERN.match(statement)
+    if match:
+        return match.group(1)
+
+
+def get_preload_database_script_hash():
+    # Hash the SQL script contents, snapshots are only valid for the script they were built from
+    path = get_preload_database_script_path()
+    if path is not None:
+        digest = hashlib.sha1()
+        with open(path, "rb") as sqlFile:
+            for chunk in iter(lambda: sqlFile.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+def get_preload_database_snapshot_digest():
+    # Snapshots are only valid for the script and the secondary indexes they were built with
+    script_digest = get_preload_database_script_hash()
+    if script_digest is not None:
+        return hashlib.sha1('%s %r' % (script_digest, PRELOAD_INDEXES)).hexdigest()
+
+
+def get_preload_database_snapshot_source():
+    # Identifies the script path the snapshots are built from, so checkouts sharing a cache keep their own
+    return hashlib.sha1(os.path.abspath(PRELOAD_DATABASE_SCRIPT_FILE_PATH)).hexdigest()[:12]
+
+
+def get_preload_database_snapshot_path(digest):
+    return os.path.join(PRELOAD_DATABASE_CACHE_DIR, '%s%s_%s.sqlite' % (
+        PRELOAD_DATABASE_SNAPSHOT_PREFIX, get_preload_database_snapshot_source(), digest))
+
+
+def get_preload_database_snapshot():
+    """
+    Return the path to a binary SQLite snapshot of the preload database script, building it on first use.
+
+    Snapshots are keyed by the content hash of preload_database.sql and the PRELOAD_INDEXES definitions, so
+    a changed script or index is never served from a stale snapshot. Returns None if there is no script or
+    the snapshot cannot be written.
+    """
+    digest = get_preload_database_snapshot_digest()
+    if digest is None:
+        return None
+
+    path = get_preload_database_snapshot_path(digest)
+    if not os.path.exists(path):
+        try:
+            build_preload_database_snapshot(path)
+        except (IOError, OSError, sqlite3.Error) as e:
+            log.warning('Unable to build preload database snapshot %s: %r', path, e)
+            return None
+        delete_stale_snapshots(path)
+    return path
+
+
+def build_preload_database_snapshot(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Build into a temporary file and rename it into place so that concurrent
+    # processes never open a partially written snapshot
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(temp_path)
+        try:
+            load_preload_database_script(connection)
+            create_preload_indexes(connection)
+            connection.commit()
+        finally:
+            connection.close()
+        # mkstemp creates the file readable only by its owner, the snapshot is shared with other users
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def delete_stale_snapshots(current):
+    # Only snapshots of the same script path, those of other checkouts sharing the cache are still in use
+    pattern = os.path.join(PRELOAD_DATABASE_CACHE_DIR, '%s%s_*.sqlite' % (
+        PRELOAD_DATABASE_SNAPSHOT_PREFIX, get_preload_database_snapshot_source()))
+    for path in glob.glob(pattern):
+        if path != current:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def copy_snapshot(path, connection, tables=None):
+    """
+    Copy the SQLite database at path into the open sqlite3 connection.
+
+    Uses the SQLite online backup API when the sqlite3 module provides it and every table is
+    wanted, otherwise the schema is recreated and the rows of each requested table (all
+    tables if tables is None) are copied through an attached database.
+    """
+    if tables is None and hasattr(connection, 'backup'):
+        source = sqlite3.connect(path)
+        try:
+            source.backup(connection)
+        finally:
+            source.close()
+        return
+
+    connection.execute('ATTACH DATABASE ? AS snapshot', (path,))
+    try:
+        schema = connection.execute("SELECT type, name, tbl_name, sql FROM snapshot.sqlite_master "
+                                    "WHERE sql IS NOT NULL ORDER BY type = 'index'").fetchall()
+        for kind, name, table, sql in schema:
+            if kind == 'table':
+                connection.execute(sql)
+                if tables is None or name in tables:
+                    connection.execute('INSERT INTO main."%s" SELECT * FROM snapshot."%s"' % (name, name))
+            elif tables is None or table in tables:
+                connection.execute(sql)
+        connection.commit()
+    finally:
+        connection.execute('DETACH DATABASE snapshot')
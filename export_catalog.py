@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Usage:
+    export_catalog.py [--format=<format>] [--output=<dir>] [<url>]
+
+Options:
+    --format=<format>  Output format: npz, parquet or feather [default: npz]
+    --output=<dir>     Directory to write one file per table to [default: catalog]
+
+    Export the parameter, stream, stream_parameter, parameter_function and nominal_depth
+    tables of preload as typed columnar files. If no URL is provided the tables are read
+    from preload_database.sql. Value table references (units, fill values, encodings, ...)
+    are resolved to categorical columns. Parquet and feather output require pyarrow.
+
+    Load the files with export_catalog.load_catalog (pandas DataFrames) or
+    export_catalog.load_catalog_arrays (NumPy record arrays).
+"""
+import glob
+import os
+from collections import OrderedDict
+
+import docopt
+import numpy as np
+import pandas as pd
+
+import database
+
+FORMATS = ['npz', 'parquet', 'feather']
+
+# Query and column types for each exported table. Nullable integer and boolean columns are float64 (missing
+# is NaN, booleans are 1.0 or 0.0), string columns are object (missing is None) and value table references
+# are categorical.
+CATALOG_TABLES = OrderedDict([
+    ('parameter', (
+        'SELECT p.id, p.name, p.netcdf_name, p.display_name, p.standard_name, p.description, '
+        'pt.value AS parameter_type, ve.value AS value_encoding, cs.value AS code_set, u.value AS unit, '
+        'fv.value AS fill_value, dpt.value AS data_product_type, p.precision, p.data_level, p.visible, '
+        'p.data_product_identifier, p.parameter_function_id, p.parameter_function_map '
+        'FROM parameter p '
+        'LEFT JOIN parameter_type pt ON pt.id = p.parameter_type_id '
+        'LEFT JOIN value_encoding ve ON ve.id = p.value_encoding_id '
+        'LEFT JOIN code_set cs ON cs.id = p.code_set_id '
+        'LEFT JOIN unit u ON u.id = p.unit_id '
+        'LEFT JOIN fill_value fv ON fv.id = p.fill_value_id '
+        'LEFT JOIN data_product_type dpt ON dpt.id = p.data_product_type_id '
+        'ORDER BY p.id',
+        {'id': 'int64', 'parameter_type': 'category', 'value_encoding': 'category', 'code_set': 'category',
+         'unit': 'category', 'fill_value': 'category', 'data_product_type': 'category', 'precision': 'float64',
+         'data_level': 'float64', 'visible': 'float64', 'parameter_function_id': 'float64'})),
+    ('stream', (
+        'SELECT s.id, s.name, s.time_parameter, s.binsize_minutes, '
+        'st.value AS stream_type, sc.value AS stream_content '
+        'FROM stream s '
+        'LEFT JOIN stream_type st ON st.id = s.stream_type_id '
+        'LEFT JOIN stream_content sc ON sc.id = s.stream_content_id '
+        'ORDER BY s.id',
+        {'id': 'int64', 'time_parameter': 'float64', 'binsize_minutes': 'int64',
+         'stream_type': 'category', 'stream_content': 'category'})),
+    ('stream_parameter', (
+        'SELECT stream_id, parameter_id FROM stream_parameter ORDER BY stream_id, parameter_id',
+        {'stream_id': 'int64', 'parameter_id': 'int64'})),
+    ('parameter_function', (
+        'SELECT f.id, f.name, ft.value AS function_type, f.function, f.owner, f.description, f.qc_flag '
+        'FROM parameter_function f '
+        'LEFT JOIN function_type ft ON ft.id = f.function_type_id '
+        'ORDER BY f.id',
+        {'id': 'int64', 'function_type': 'category', 'owner': 'category'})),
+    ('nominal_depth', (
+        'SELECT id, subsite, node, sensor, depth FROM nominal_depth ORDER BY id',
+        {'id': 'int64', 'subsite': 'category', 'node': 'category', 'depth': 'float64'})),
+])
+
+PRELOAD_TABLES = ['parameter', 'parameter_type', 'value_encoding', 'code_set', 'unit', 'fill_value',
+                  'data_product_type', 'stream', 'stream_type', 'stream_content', 'stream_parameter',
+                  'parameter_function', 'function_type', 'nominal_depth']
+
+# Suffixes used to store categorical and string columns in npz files, which cannot hold pandas types
+CATEGORIES_SUFFIX = '__categories'
+COLUMNS_KEY = '__columns__'
+
+
+def read_catalog_tables(bind):
+    """Read each of CATALOG_TABLES from bind (an SQLAlchemy engine or sqlite3 connection) into a typed DataFrame"""
+    frames = OrderedDict()
+    for table, (query, dtypes) in CATALOG_TABLES.items():
+        frame = pd.read_sql(query, bind)
+        for column, dtype in dtypes.items():
+            frame[column] = frame[column].astype(dtype)
+        frames[table] = frame
+    return frames
+
+
+def write_catalog(frames, directory, fmt='npz'):
+    if fmt not in FORMATS:
+        raise ValueError('Unsupported catalog format: %s' % fmt)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for table, frame in frames.items():
+        path = os.path.join(directory, '%s.%s' % (table, fmt))
+        if fmt == 'parquet':
+            frame.to_parquet(path)
+        elif fmt == 'feather':
+            frame.to_feather(path)
+        else:
+            np.savez_compressed(path, **frame_to_arrays(frame))
+
+
+def frame_to_arrays(frame):
+    arrays = {COLUMNS_KEY: np.array(frame.columns, dtype=np.unicode_)}
+    for column in frame.columns:
+        values = frame[column]
+        if hasattr(values, 'cat'):
+            arrays[column] = values.cat.codes.values
+            arrays[column + CATEGORIES_SUFFIX] = np.array(values.cat.categories, dtype=np.unicode_)
+        elif values.dtype == object:
+            # store strings as fixed width unicode so the file can be loaded without pickle, None becomes ''
+            arrays[column] = np.array(values.fillna(''), dtype=np.unicode_)
+        else:
+            arrays[column] = values.values
+    return arrays
+
+
+def arrays_to_frame(arrays):
+    columns = arrays[COLUMNS_KEY].tolist()
+    data = OrderedDict()
+    for column in columns:
+        if column + CATEGORIES_SUFFIX in arrays:
+            data[column] = pd.Categorical.from_codes(arrays[column], arrays[column + CATEGORIES_SUFFIX])
+        elif arrays[column].dtype.kind == 'U':
+            values = arrays[column].astype(object)
+            values[values == u''] = None
+            data[column] = values
+        else:
+            data[column] = arrays[column]
+    return pd.DataFrame(data, columns=columns)
+
+
+def load_catalog(directory='catalog'):
+    """Load the tables written by write_catalog as a dict of table name to DataFrame"""
+    frames = {}
+    for fmt in FORMATS:
+        for path in glob.glob(os.path.join(directory, '*.%s' % fmt)):
+            table = os.path.splitext(os.path.basename(path))[0]
+            if fmt == 'parquet':
+                frames[table] = pd.read_parquet(path)
+            elif fmt == 'feather':
+                frames[table] = pd.read_feather(path)
+            else:
+                arrays = np.load(path)
+                try:
+                    frames[table] = arrays_to_frame(arrays)
+                finally:
+                    arrays.close()
+    return frames
+
+
+def load_catalog_arrays(directory='catalog'):
+    """Load the tables written by write_catalog as a dict of table name to NumPy record array"""
+    return {table: frame.to_records(index=False) for table, frame in load_catalog(directory).items()}
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    fmt = options['--format']
+    if fmt not in FORMATS:
+        raise docopt.DocoptExit('Unsupported format: %s' % fmt)
+
+    engine = database.create_engine_from_url(options['<url>'], tables=PRELOAD_TABLES)
+    try:
+        frames = read_catalog_tables(engine)
+    finally:
+        engine.dispose()
+    write_catalog(frames, options['--output'], fmt)
+
+
+if __name__ == '__main__':
+    main()
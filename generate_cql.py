@@ -8,11 +8,10 @@ import database
 import numpy as np
 from ooi_data.postgres.model import Stream
 
-engine = database.create_engine_from_url(None)
+PRELOAD_TABLES = ['stream', 'stream_dependency', 'stream_parameter', 'parameter', 'parameter_type',
+                  'value_encoding', 'fill_value']
 
-
-Session = database.create_scoped_session(engine)
-session = Session()
+Session = database.create_process_scoped_session(tables=PRELOAD_TABLES)
 
 
 DROP_KEYSPACE = 'drop keyspace ooi;\n\n'
@@ -308,7 +307,7 @@ def generate(java_template, cql_template, cql_drop_template, mapper_template):
                 fh.write('DROP TABLE ooi.%s;' % table + '\n\n')
                 fh.write(schema)
 
-        streams = session.query(Stream).all()
+        streams = Session().query(Stream).all()
         for stream in streams:
             # Don't generate CQL or java classes for virtual streams
             if stream.source_streams:
@@ -350,4 +349,5 @@ def main():
     generate(java_template, cql_template, cql_drop_template, mapper_template)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -17,11 +17,10 @@ from collections import namedtuple
 
 import docopt
 
-from ooi_data.postgres.model import Stream, Parameter, MetadataBase
-from sqlalchemy import or_
+from catalog import create_catalog
 
-from database import create_engine_from_url, create_scoped_session
 
+PRELOAD_TABLES = ['parameter', 'parameter_type', 'value_encoding', 'unit', 'stream', 'stream_parameter']
 
 indent = '    '
 max_indent = 6
@@ -33,15 +32,19 @@ header = Header('name', 'type', 'encoding', 'units', 'pfid', 'dpi')
 header2 = Header('-' * 40, '-' * 15, '-' * 10, '-' * 30, '-' * 10, '-' * 10)
 
 
-def get_objects_from_preload(klass, fields):
+def get_objects_from_preload(catalog, stream, fields):
     for field in fields:
-        if field.isnumeric():
-            yield klass.query.get(field)
-        if klass is Parameter:
-            for each in klass.query.filter(or_(klass.name == field, klass.data_product_identifier == field)):
+        if stream:
+            if field.isnumeric():
+                yield catalog.get_stream(int(field))
+            each = catalog.get_stream_by_name(field)
+            if each is not None:
                 yield each
         else:
-            for each in klass.query.filter(klass.name == field):
+            if field.isnumeric():
+                yield catalog.get_parameter(int(field))
+            matches = set(catalog.get_parameters_by_name(field)).union(catalog.get_parameters_by_dpi(field))
+            for each in sorted(matches):
                 yield each
 
 
@@ -115,15 +118,13 @@ def main():
     name_or_ids = [s.decode('UTF8') for s in options['<name_or_id>']]
     stream = options['stream']
 
-    engine = create_engine_from_url(None)
-    session = create_scoped_session(engine)
-    MetadataBase.query = session.query_property()
+    catalog = create_catalog(tables=PRELOAD_TABLES)
 
     if stream:
-        streams = get_objects_from_preload(Stream, name_or_ids)
+        streams = get_objects_from_preload(catalog, stream, name_or_ids)
         list_stream_parameters(name_or_ids, streams)
     else:
-        parameters = get_objects_from_preload(Parameter, name_or_ids)
+        parameters = get_objects_from_preload(catalog, stream, name_or_ids)
         list_parameters(name_or_ids, parameters)
 
 
@@ -1,18 +1,58 @@
 #!/usr/bin/env python
 """
 Usage:
-    load_preload.py
-    load_preload.py <url>
+    load_preload.py [--full] [--profile=<file>] [--compress=<format>]
+    load_preload.py [--full] [--batch-size=<n>] [--profile=<file>] <url>...
+    load_preload.py --bulk [--profile=<file>] <url>...
+    load_preload.py --dry-run [<url>]
+    load_preload.py --watch [--interval=<secs>] [--compress=<format>] [<url>]
+
+Options:
+    --compress=<format>  Write preload_database.sql.gz (gzip) or preload_database.sql.xz (xz)
+                         instead of the uncompressed script
+    --full               Apply every CSV row, not just the rows changed since the last run
+    --bulk               Apply every CSV row to a PostgreSQL database using COPY and
+                         set-based upserts and deletes instead of the ORM. Each table is
+                         committed once, so it cannot be combined with --batch-size
+    --batch-size=<n>     Commit the changed rows of each table in batches of n rows, rather
+                         than once per table. Smaller batches hold locks for less time, an
+                         interrupted load resumes after the last committed batch
+    --profile=<file>     Write the wall time, rows applied, SQL statements and ORM objects
+                         flushed by each stage of the load to file as JSON (by target if
+                         more than one URL is given)
+    --dry-run            Write the changes the CSV files would make to the database to stdout
+                         as JSON, without changing the database
+    --watch              After loading, keep polling the CSV files and re-apply the stages which
+                         read any file that changed. Without a URL preload_database.sql is
+                         rewritten after each change, with a URL the changes are written to
+                         stdout as JSON (as --dry-run) before they are applied
+    --interval=<secs>    Seconds between polls of the CSV files in watch mode [default: 1]
+
+    CSV rows are only applied to the database if they changed since they were last applied,
+    according to the content hashes stored in the preload_row_hash table. Use --full if the
+    database has been modified by anything other than this script.
 
     If no URL is provided the script will create an in-memory database
     (populated from preload_database.sql if it exists), update that database
     and write the result to preload_database.sql
+
+    If more than one URL is provided the CSV files are read and validated once and
+    applied to every database concurrently. The outcome and wall time of each load
+    are written to stdout as JSON, the exit status is 1 if any of them failed.
 """
 
+import hashlib
+import io
 import json
 import logging
 import os
+import re
+import sys
+import time
 from collections import Counter
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from distutils.util import strtobool
 from numbers import Number
 
@@ -24,22 +64,53 @@ from ooi_data.postgres.model.preload import (ParameterType, ValueEncoding, CodeS
                                              Parameter, Stream, StreamDependency, NominalDepth,
                                              StreamType, StreamContent, Dimension,
                                              DataProductType)
-from sqlalchemy.orm import sessionmaker, joinedload
+from sqlalchemy import and_, bindparam, event, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
 
 import database
+from validate_preload import loadable_rows, validate_catalog
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 logging.basicConfig()
 
-CSV_DIR = os.path.join(os.path.dirname(__file__), 'csv')
-IGNORE_SCENARIOS = ['VOID', 'DOC', 'DOC:WARNING', 'NOTE']
-CSV_FILES = ['ParameterDefs', 'ParameterFunctions', 'ParameterDictionary', 'BinSizes']
+# Set PRELOAD_CSV_DIR to load the CSV files from another directory
+CSV_DIR = os.environ.get('PRELOAD_CSV_DIR', os.path.join(os.path.dirname(__file__), 'csv'))
+CSV_FILES = ['ParameterDefs', 'ParameterFunctions', 'ParameterDictionary', 'BinSizes', 'nominal_depths']
+# Columns of each CSV file read by the loader, the rest are skipped by the parser
+CSV_COLUMNS = {
+    'ParameterDefs': ['scenario', 'id', 'name', 'netcdf_name', 'parametertype', 'dimensions', 'valueencoding',
+                      'codeset', 'unitofmeasure', 'fillvalue', 'displayname', 'precision', 'visible',
+                      'parameterfunctionid', 'parameterfunctionmap', 'standardname', 'dataproductidentifier',
+                      'description', 'dataproducttype', 'datalevel'],
+    'ParameterFunctions': ['scenario', 'id', 'name', 'functiontype', 'function', 'owner', 'description', 'qcflag'],
+    'ParameterDictionary': ['scenario', 'id', 'name', 'parameterids', 'temporalparameter', 'streamdependency',
+                            'streamtype', 'streamcontent'],
+    'BinSizes': ['stream', 'binsize'],
+    'nominal_depths': ['designator', 'depth'],
+}
+# CSV columns converted to numbers after they are read, a cell which is not a number is missing
+CSV_NUMERIC_COLUMNS = {'binsize'}
 DEFAULT_PRECISION = 5
 DEFAULT_BIN_SIZE_MINUTES = 1440
+# Maximum number of ids in a single IN clause
+ID_CHUNK_SIZE = 500
+# CSV files read by each stage of update_db, in the order the stages are applied. A stage also reads
+# the files of the stages whose rows it links to (streams link to parameters).
+STAGE_FILES = [
+    ('nominal_depths', {'nominal_depths'}),
+    ('parameter_funcs', {'ParameterFunctions'}),
+    ('parameters', {'ParameterDefs', 'ParameterFunctions'}),
+    ('streams', {'ParameterDictionary', 'BinSizes', 'ParameterDefs'}),
+    ('stream_dependencies', {'ParameterDictionary'}),
+]
+# Parameter columns which keep their current value if a ParameterDefs row leaves them empty
+PARAMETER_OPTIONAL_COLUMNS = {'precision', 'data_level', 'parameter_function_id', 'parameter_function_map'}
 
 
 dataframes = {}
+parsed_dimensions = {}
 
 value_table_map_map = {
     'ParameterDefs': {
@@ -61,283 +132,496 @@ value_table_map_map = {
 }
 
 
-def validate(row, prefix, mandatory_cols):
-    if any((getattr(row, col) is None for col in mandatory_cols)):
-        return False
-    return all((row.id.startswith(prefix), validate_scenario(row.scenario)))
-
-
-def validate_scenario(value):
-    if value is not None:
-        scenarios = [s.strip() for s in value.split(',')]
-        for scenario in scenarios:
-            if scenario in IGNORE_SCENARIOS:
-                return False
-
-    return True
-
-
-def validate_parameter_row(row):
-    # Check that the mandatory fields are valid.
-    return validate(row, 'PD', ['id', 'name', 'parametertype', 'valueencoding'])
-
+class RowHashes(object):
+    """
+    Content hashes of the CSV rows from one source which were applied to the database by previous runs.
+
+    Rows whose hash is unchanged do not need to be applied again. If full is True the stored hashes are
+    ignored (every row is reported changed) and replaced when saved.
+    """
+    def __init__(self, session, source, full=False):
+        self.session = session
+        self.source = source
+        self.clear_stored = full
+        self.current = {}
+        self.stored = {}
+        if not full:
+            table = database.preload_row_hash
+            query = session.query(table.c.key, table.c.hash).filter(table.c.source == source)
+            self.stored = dict(query)
+
+    def changed(self, key, *values):
+        """Record the hash of values for the row identified by key, return True if it has changed"""
+        key = '%s' % key
+        self.current[key] = hashlib.sha1(repr(values).encode('utf8')).hexdigest()
+        return self.stored.get(key) != self.current[key]
+
+    def save(self, keys=None):
+        """
+        Store the hashes recorded by changed in the current transaction. If keys is given only the
+        hashes of those rows are stored, otherwise all of them are and the hashes of rows which
+        were not recorded are removed.
+        """
+        table = database.preload_row_hash
+        if self.clear_stored:
+            # the stored hashes were ignored, remove them on the first save
+            self.session.execute(table.delete().where(table.c.source == self.source))
+            self.clear_stored = False
+        keys = self.current if keys is None else {'%s' % key for key in keys}.intersection(self.current)
+
+        new = {key: self.current[key] for key in keys if self.stored.get(key) != self.current[key]}
+        stale = [key for key in new if key in self.stored]
+        if keys is self.current:
+            stale.extend(key for key in self.stored if key not in self.current)
+
+        for each in chunks(sorted(stale), ID_CHUNK_SIZE):
+            self.session.execute(table.delete().where(and_(table.c.source == self.source, table.c.key.in_(each))))
+        if new:
+            self.session.execute(table.insert(), [{'source': self.source, 'key': key, 'hash': value}
+                                                  for key, value in sorted(new.items())])
+
+        for key in stale:
+            del self.stored[key]
+        self.stored.update(new)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def query_by_ids(query, column, ids):
+    # Results of query restricted to rows whose column is in ids (or any other values)
+    for each in chunks(sorted(ids), ID_CHUNK_SIZE):
+        for item in query.filter(column.in_(each)):
+            yield item
+
+
+def batches(ids, batch_size=None):
+    # The sorted ids in lists of batch_size, or in a single list if batch_size is None
+    ids = sorted(ids)
+    if batch_size:
+        return list(chunks(ids, batch_size))
+    return [ids]
+
+
+def checkpoint(session, hashes, keys, batch_size):
+    """
+    When loading in batches, commit a batch together with the hashes of its rows. A load
+    interrupted after the commit resumes with the next batch, as the rows of this one are unchanged.
+    """
+    if batch_size:
+        hashes.save(keys)
+        session.commit()
 
-def validate_stream_row(row):
-    # Check that the mandatory fields are valid.
-    return validate(row, 'DICT', ['id', 'name', 'parameterids'])
 
+def parse_ids(value, prefix):
+    # Parse the integer ids from a comma separated list of prefixed ids, e.g. 'PD1, PD7'
+    if value is None:
+        return []
+    ids = [each.strip() for each in value.split(',')]
+    return [int(each[len(prefix):]) for each in ids if each.startswith(prefix)]
 
-def validate_parameter_func_row(row):
-    # Check that the mandatory fields are valid.
-    return validate(row, 'PFID', ['id', 'functiontype', 'function'])
 
+def parameter_values(parameter_id, row, value_table_map):
+    """
+    Column values of the parameter defined by a ParameterDefs row.
 
-def create_or_update_parameter(session, parameter_id, row, value_table_map, parameter=None):
+    The columns in PARAMETER_OPTIONAL_COLUMNS are None when the row does not provide
+    them, an existing parameter keeps its current value for those columns.
+    """
     def get_it(value_map, this_row, name):
         return value_map[name].get(getattr(this_row, name))
 
-    if parameter is None:
-        parameter = Parameter()
-        session.add(parameter)
-
-    # Simple columns
-    parameter.id = parameter_id
-    parameter.name = row.name
-    parameter.display_name = row.displayname
-    parameter.standard_name = row.standardname
-    parameter.data_product_identifier = row.dataproductidentifier
-    parameter.description = row.description
-
-    # References
-    parameter.parameter_type_id = get_it(value_table_map, row, 'parametertype')
-    parameter.value_encoding_id = get_it(value_table_map, row, 'valueencoding')
-    parameter.code_set_id = get_it(value_table_map, row, 'codeset')
-    parameter.unit_id = get_it(value_table_map, row, 'unitofmeasure')
-    parameter.fill_value_id = get_it(value_table_map, row, 'fillvalue')
-    parameter.data_product_type_id = get_it(value_table_map, row, 'dataproducttype')
-
-    if row.dimensions is not None:
-        existing_dimensions = {dim.id for dim in parameter.dimensions}
-        dims = json.loads(row.dimensions)
-        new_dimensions = {value_table_map['dimensions'].get(dim) for dim in dims}
-
-        if existing_dimensions != new_dimensions:
-            parameter.dimensions = [session.query(Dimension).get(dim) for dim in new_dimensions]
+    values = {
+        # Simple columns
+        'id': parameter_id,
+        'name': row.name,
+        'display_name': row.displayname,
+        'standard_name': row.standardname,
+        'data_product_identifier': row.dataproductidentifier,
+        'description': row.description,
+
+        # References
+        'parameter_type_id': get_it(value_table_map, row, 'parametertype'),
+        'value_encoding_id': get_it(value_table_map, row, 'valueencoding'),
+        'code_set_id': get_it(value_table_map, row, 'codeset'),
+        'unit_id': get_it(value_table_map, row, 'unitofmeasure'),
+        'fill_value_id': get_it(value_table_map, row, 'fillvalue'),
+        'data_product_type_id': get_it(value_table_map, row, 'dataproducttype'),
+
+        'precision': None,
+        'data_level': None,
+        'parameter_function_id': None,
+        'parameter_function_map': None,
+    }
 
     # Special handling
     if row.precision == 'default':
-        parameter.precision = DEFAULT_PRECISION
+        values['precision'] = DEFAULT_PRECISION
     elif row.precision is not None:
         try:
-            parameter.precision = int(row.precision)
+            values['precision'] = int(row.precision)
         except (ValueError, TypeError):
             log.error('Invalid precision in row: %r', row)
 
     if row.datalevel is not None:
         dl = row.datalevel
         dl = int(dl.replace('L', ''))
-        parameter.data_level = dl
+        values['data_level'] = dl
 
     if row.parameterfunctionid is not None:
         pfid = row.parameterfunctionid
         if pfid.startswith('PFID'):
-            parameter.parameter_function_id = int(pfid[4:])
+            values['parameter_function_id'] = int(pfid[4:])
 
     if row.parameterfunctionmap is not None:
         try:
             param_map = row.parameterfunctionmap
-            parameter.parameter_function_map = json.loads(param_map)
+            values['parameter_function_map'] = json.loads(param_map)
         except SyntaxError as e:
             log.error('Error parsing parameter_function_map for row: %r %r', row, e)
 
     if row.visible is not None:
         # handles y, yes, t, true, on, 1, n, no, f, false, off, and 0
-        parameter.visible = strtobool(row.visible)
+        values['visible'] = strtobool(row.visible)
     else:
-        parameter.visible = True
+        values['visible'] = True
 
     # netcdf_name is used to override name for output files
     # defaulting netcdf_name to name removes the need for null checks downstream
-    parameter.netcdf_name = row.netcdf_name if row.netcdf_name else row.name
+    values['netcdf_name'] = row.netcdf_name if row.netcdf_name else row.name
+    return values
+
 
+def parse_dimensions(value):
+    # Parse a dimensions cell, most parameters share a handful of distinct values so each is parsed once
+    if value not in parsed_dimensions:
+        parsed_dimensions[value] = tuple(json.loads(value))
+    return parsed_dimensions[value]
 
-def process_parameters(session):
+
+def parameter_dimension_ids(row, value_table_map):
+    # Ids of the dimensions of a ParameterDefs row, None if the row does not specify its dimensions
+    if row.dimensions is not None:
+        return {value_table_map['dimensions'].get(dim) for dim in parse_dimensions(row.dimensions)}
+
+
+def create_or_update_parameter(session, parameter_id, row, value_table_map, parameter=None):
+    if parameter is None:
+        parameter = Parameter()
+        session.add(parameter)
+
+    for name, value in parameter_values(parameter_id, row, value_table_map).items():
+        if value is not None or name not in PARAMETER_OPTIONAL_COLUMNS:
+            setattr(parameter, name, value)
+
+    # The parameter_dimension rows are written by update_association
+    return parameter_dimension_ids(row, value_table_map)
+
+
+def process_parameters(session, full=False, batch_size=None):
     log.info('Processing parameters')
     name = 'ParameterDefs'
 
-    all_params = {parameter.id: parameter for parameter in
-                  session.query(Parameter).options(joinedload('dimensions'))}
+    existing_ids = {parameter_id for parameter_id, in session.query(Parameter.id)}
+    hashes = RowHashes(session, name, full)
+    csv_ids = set()
     csv_params = {}
 
     dataframe = dataframes[name]
     value_table_map = process_value_table_map(session, name)
 
-    for row in dataframe.itertuples(index=False):
-        if validate_parameter_row(row):
-            parameter_id = int(row.id[2:])
+    for row in loadable_rows(dataframe, 'ParameterDefs').itertuples(index=False):
+        parameter_id = int(row.id[2:])
+        csv_ids.add(parameter_id)
+        if hashes.changed(parameter_id, row) or parameter_id not in existing_ids:
             csv_params[parameter_id] = row
 
-    delete_params = set(all_params).difference(csv_params)
-
-    for parameter_id in csv_params:
-        create_or_update_parameter(session, parameter_id, csv_params[parameter_id],
-                                   value_table_map, parameter=all_params.get(parameter_id))
-
-    # Remove rows from the database for deleted Parameters.
-    for parameter_id in delete_params:
-        session.delete(all_params[parameter_id])
-
+    delete_params = existing_ids.difference(csv_ids)
+    log.info('Parameters changed: %d deleted: %d', len(csv_params), len(delete_params))
+
+    table = Parameter.dimensions.property.secondary
+    dimensions_added = dimensions_removed = 0
+    for batch in batches(delete_params.union(csv_params), batch_size):
+        all_params = {parameter.id: parameter for parameter in
+                      query_by_ids(session.query(Parameter), Parameter.id, batch)}
+
+        # Dimensions are only replaced for parameters which specify them, deleted parameters lose theirs
+        pairs = set()
+        dimension_params = delete_params.intersection(batch)
+        for parameter_id in batch:
+            if parameter_id in csv_params:
+                dimension_ids = create_or_update_parameter(session, parameter_id, csv_params[parameter_id],
+                                                           value_table_map, parameter=all_params.get(parameter_id))
+                if dimension_ids is not None:
+                    dimension_params.add(parameter_id)
+                    pairs.update((parameter_id, dim) for dim in dimension_ids if dim is not None)
+
+        session.flush()
+        added, removed = update_association(session, table.c.parameter_id, table.c.dimension_id,
+                                            dimension_params, pairs)
+        dimensions_added += added
+        dimensions_removed += removed
+
+        # Remove rows from the database for deleted Parameters.
+        for parameter_id in delete_params.intersection(batch):
+            session.delete(all_params[parameter_id])
+
+        checkpoint(session, hashes, batch, batch_size)
+
+    log.info('Parameter dimensions added: %d removed: %d', dimensions_added, dimensions_removed)
+    hashes.save()
     session.commit()
+    return len(csv_params) + len(delete_params)
+
+
+def parameter_function_values(func_id, row, value_table_map):
+    # Column values of the parameter function defined by a ParameterFunctions row
+    return {
+        'id': func_id,
+        'name': row.name,
+        'function_type_id': value_table_map['functiontype'].get(row.functiontype),
+        'function': row.function,
+        'owner': row.owner,
+        'description': row.description,
+        'qc_flag': row.qcflag,
+    }
 
 
 def create_or_update_parameter_func(session, func_id, row, value_table_map, func=None):
     if func is None:
         func = ParameterFunction()
         session.add(func)
-    func.id = func_id
-    func.name = row.name
-    func.function_type_id = value_table_map['functiontype'].get(row.functiontype)
-    func.function = row.function
-    func.owner = row.owner
-    func.description = row.description
-    func.qc_flag = row.qcflag
+    for name, value in parameter_function_values(func_id, row, value_table_map).items():
+        setattr(func, name, value)
 
 
-def process_parameter_funcs(session):
+def process_parameter_funcs(session, full=False, batch_size=None):
     name = 'ParameterFunctions'
     log.info('Processing parameter functions')
     dataframe = dataframes[name]
     value_table_map = process_value_table_map(session, name)
 
-    existing_functions = {func.id: func for func in session.query(ParameterFunction)}
+    existing_ids = {func_id for func_id, in session.query(ParameterFunction.id)}
+    hashes = RowHashes(session, name, full)
+    csv_ids = set()
     csv_functions = {}
 
-    for row in dataframe.itertuples(index=False):
-        if validate_parameter_func_row(row):
-            func_id = int(row.id[4:])
+    for row in loadable_rows(dataframe, 'ParameterFunctions').itertuples(index=False):
+        func_id = int(row.id[4:])
+        csv_ids.add(func_id)
+        if hashes.changed(func_id, row) or func_id not in existing_ids:
             csv_functions[func_id] = row
 
-    delete_functions = set(existing_functions).difference(csv_functions)
-
-    for func_id in csv_functions:
-        create_or_update_parameter_func(session, func_id, csv_functions[func_id],
-                                        value_table_map, func=existing_functions.get(func_id))
-
-    for func_id in delete_functions:
-        session.delete(existing_functions[func_id])
-
+    delete_functions = existing_ids.difference(csv_ids)
+    log.info('Parameter functions changed: %d deleted: %d', len(csv_functions), len(delete_functions))
+
+    for batch in batches(delete_functions.union(csv_functions), batch_size):
+        existing_functions = {func.id: func for func in
+                              query_by_ids(session.query(ParameterFunction), ParameterFunction.id, batch)}
+        for func_id in batch:
+            if func_id in csv_functions:
+                create_or_update_parameter_func(session, func_id, csv_functions[func_id],
+                                                value_table_map, func=existing_functions.get(func_id))
+            else:
+                session.delete(existing_functions[func_id])
+        checkpoint(session, hashes, batch, batch_size)
+
+    hashes.save()
     session.commit()
+    return len(csv_functions) + len(delete_functions)
 
 
-def create_or_update_stream(session, stream_id, row, value_table_map, bin_sizes, stream=None):
+def stream_values(stream_id, row, value_table_map, bin_sizes):
+    # Column values of the stream defined by a ParameterDictionary row
     def get_it(value_map, this_row, name):
         return value_map[name].get(getattr(this_row, name))
 
-    if stream is None:
-        stream = Stream()
-        stream.id = stream_id
-        session.add(stream)
-
-    stream.binsize_minutes = bin_sizes.get(row.name, DEFAULT_BIN_SIZE_MINUTES)
-    stream.name = row.name
-
     time_param = row.temporalparameter
     if time_param is not None and time_param.startswith('PD'):
         time_param = int(time_param.strip()[2:])
     else:
         time_param = 7
-    stream.time_parameter = time_param
 
-    stream.stream_type_id = get_it(value_table_map, row, 'streamtype')
-    stream.stream_content_id = get_it(value_table_map, row, 'streamcontent')
+    return {
+        'id': stream_id,
+        'name': row.name,
+        'binsize_minutes': bin_sizes.get(row.name, DEFAULT_BIN_SIZE_MINUTES),
+        'time_parameter': time_param,
+        'stream_type_id': get_it(value_table_map, row, 'streamtype'),
+        'stream_content_id': get_it(value_table_map, row, 'streamcontent'),
+    }
+
+
+def create_or_update_stream(session, stream_id, row, value_table_map, bin_sizes, stream=None):
+    if stream is None:
+        stream = Stream()
+        stream.id = stream_id
+        session.add(stream)
+
+    for name, value in stream_values(stream_id, row, value_table_map, bin_sizes).items():
+        setattr(stream, name, value)
 
-    params = [p.strip() for p in row.parameterids.split(',')]
-    params = [int(p[2:]) for p in params if p.startswith('PD')]
+    params = parse_ids(row.parameterids, 'PD')
 
     if sorted(params) != sorted(set(params)):
         c = Counter(params) - Counter(set(params))
         log.error('duplicate params: %s %s', stream, set(c))
 
-    # From the parameters id list create the parameter objects and
-    # add them to the stream parameter list
-    current_params = {p.id for p in stream.parameters}
-    expected_params = set(params)
-    if current_params != expected_params:
-        params = session.query(Parameter).filter(Parameter.id.in_(expected_params)).all()
-        stream.parameters = params
+    # The stream_parameter rows are written by update_stream_parameters
+    return set(params)
 
 
-def process_streams(session):
+def update_stream_parameters(session, stream_ids, pairs):
+    # Make the stream_parameter rows of the given streams match pairs, a set of (stream id, parameter id)
+    table = Stream.parameters.property.secondary
+    return update_association(session, table.c.stream_id, table.c.parameter_id, stream_ids, pairs)
+
+
+def update_association(session, owner, other, owner_ids, pairs):
+    """
+    Make the rows of an association table with the given owner_ids match pairs, a set of (owner id, other id).
+
+    Only the difference is written, new rows with one executemany and removed rows with one
+    delete per owner. Any new rows the association refers to must already be flushed.
+    Returns the number of rows added and removed.
+    """
+    table = owner.table
+    query = session.query(owner, other)
+    existing = {tuple(pair) for pair in query_by_ids(query, owner, owner_ids)}
+
+    new = sorted(pairs.difference(existing))
+    if new:
+        session.execute(table.insert(), [{owner.name: owner_id, other.name: other_id} for owner_id, other_id in new])
+
+    removed = {}
+    for owner_id, other_id in existing.difference(pairs):
+        removed.setdefault(owner_id, []).append(other_id)
+    for owner_id, other_ids in sorted(removed.items()):
+        session.execute(table.delete().where(and_(owner == owner_id, other.in_(other_ids))))
+    return len(new), sum(len(each) for each in removed.values())
+
+
+def process_streams(session, full=False, batch_size=None):
     log.info('Processing streams')
     name = 'ParameterDictionary'
     dataframe = dataframes[name]
     value_table_map = process_value_table_map(session, name)
     bin_sizes = process_bin_sizes()
 
-    all_streams = {stream.id: stream for stream in session.query(Stream).options(joinedload('parameters'))}
+    existing_ids = {stream_id for stream_id, in session.query(Stream.id)}
+    parameter_ids = {parameter_id for parameter_id, in session.query(Parameter.id)}
+    hashes = RowHashes(session, name, full)
+    csv_ids = set()
     csv_streams = {}
 
-    for row in dataframe.itertuples(index=False):
-        if validate_stream_row(row):
-            stream_id = int(row.id[4:])
+    for row in loadable_rows(dataframe, 'ParameterDictionary').itertuples(index=False):
+        stream_id = int(row.id[4:])
+        csv_ids.add(stream_id)
+        # the stream also changes with its bin size and when any of its parameters are added or removed
+        linked = sorted(parameter_ids.intersection(parse_ids(row.parameterids, 'PD')))
+        if hashes.changed(stream_id, row, bin_sizes.get(row.name), linked) or stream_id not in existing_ids:
             csv_streams[stream_id] = row
 
-    delete_streams = set(all_streams).difference(csv_streams)
+    delete_streams = existing_ids.difference(csv_ids)
+    log.info('Streams changed: %d deleted: %d', len(csv_streams), len(delete_streams))
 
-    for stream_id in csv_streams:
-        create_or_update_stream(session, stream_id, csv_streams[stream_id],
-                                value_table_map, bin_sizes, stream=all_streams.get(stream_id))
+    parameters_added = parameters_removed = 0
+    for batch in batches(delete_streams.union(csv_streams), batch_size):
+        all_streams = {stream.id: stream for stream in query_by_ids(session.query(Stream), Stream.id, batch)}
 
-    for stream_id in delete_streams:
-        session.delete(all_streams[stream_id])
+        # Link each stream to those of its parameters which exist
+        pairs = set()
+        for stream_id in batch:
+            if stream_id in csv_streams:
+                params = create_or_update_stream(session, stream_id, csv_streams[stream_id],
+                                                 value_table_map, bin_sizes, stream=all_streams.get(stream_id))
+                pairs.update((stream_id, parameter_id) for parameter_id in params.intersection(parameter_ids))
 
-    session.commit()
+        session.flush()
+        added, removed = update_stream_parameters(session, batch, pairs)
+        parameters_added += added
+        parameters_removed += removed
 
+        for stream_id in delete_streams.intersection(batch):
+            session.delete(all_streams[stream_id])
 
-def process_stream_dependencies(session):
+        checkpoint(session, hashes, batch, batch_size)
+
+    log.info('Stream parameters added: %d removed: %d', parameters_added, parameters_removed)
+
+    hashes.save()
+    session.commit()
+    return len(csv_streams) + len(delete_streams)
+
+
+def reconcile_stream_dependencies(existing, csv_depends, stream_ids):
+    """
+    Compare the existing (source id, product id) dependencies with csv_depends, a dict of
+    product stream id to source stream ids. Only the product streams in csv_depends are reconciled.
+
+    Returns the (source id, product id) pairs to add and to remove and the set of
+    source ids which are not in stream_ids.
+    """
+    sources_by_product = {}
+    for source_id, product_id in existing:
+        sources_by_product.setdefault(product_id, set()).add(source_id)
+
+    added = set()
+    removed = set()
+    missing = set()
+    for product_id, depend_ids in csv_depends.items():
+        depend_ids = set(depend_ids)
+        missing.update(depend_ids.difference(stream_ids))
+        wanted = depend_ids.intersection(stream_ids)
+        current = sources_by_product.get(product_id, set())
+        added.update((source_id, product_id) for source_id in wanted.difference(current))
+        removed.update((source_id, product_id) for source_id in current.difference(wanted))
+    return added, removed, missing
+
+
+def process_stream_dependencies(session, full=False, batch_size=None):
     log.info('Processing stream dependencies')
     name = 'ParameterDictionary'
     dataframe = dataframes[name]
 
-    streams = {stream.id: stream for stream in session.query(Stream)}
-    depends = {(d.source_stream_id, d.product_stream_id): d for d in session.query(StreamDependency)}
+    stream_ids = {stream_id for stream_id, in session.query(Stream.id)}
+    hashes = RowHashes(session, 'StreamDependency', full)
+    csv_depends = {}
 
-    for row in dataframe.itertuples(index=False):
-        if validate_stream_row(row):
-            stream_id = int(row.id[4:])
-            stream = streams.get(stream_id)
-            if stream is not None:
-                # Add the Stream Dependencies that don't already exist.
-                dependencies = row.streamdependency
-                depend_ids = []
-                if dependencies is not None:
-                    depend_dicts = [each.strip() for each in dependencies.split(',')]
-                    depend_dicts = [int(each[4:]) for each in depend_dicts if each.startswith('DICT')]
-                    for depend_id in depend_dicts:
-                        depend_ids.append(depend_id)
-
-                        source_stream = streams.get(depend_id)
-
-                        if source_stream is not None:
-                            dependency = depends.get((depend_id, stream_id))
-
-                            if dependency is not None:
-                                continue
-
-                            sd = StreamDependency()
-                            sd.source_stream_id = depend_id
-                            sd.product_stream_id = stream_id
-                            session.add(sd)
-                        else:
-                            log.error('Stream dependency does not exist in the database: %s', depend_id)
-
-                # Delete the Stream Dependencies that have been removed.
-                for source_id, product_id in depends:
-                    if product_id == stream_id:
-                        if source_id not in depend_ids:
-                            session.delete(depends.get((source_id, product_id)))
+    for row in loadable_rows(dataframe, 'ParameterDictionary').itertuples(index=False):
+        stream_id = int(row.id[4:])
+        if stream_id in stream_ids:
+            depend_ids = parse_ids(row.streamdependency, 'DICT')
+            # the dependencies also change when any of the source streams are added or removed
+            if hashes.changed(stream_id, depend_ids, sorted(stream_ids.intersection(depend_ids))):
+                csv_depends[stream_id] = depend_ids
+
+    log.info('Stream dependencies changed: %d', len(csv_depends))
+
+    for batch in batches(csv_depends, batch_size):
+        depends = {(d.source_stream_id, d.product_stream_id): d for d in
+                   query_by_ids(session.query(StreamDependency), StreamDependency.product_stream_id, batch)}
+        added, removed, missing = reconcile_stream_dependencies(
+            depends, {stream_id: csv_depends[stream_id] for stream_id in batch}, stream_ids)
+        for depend_id in sorted(missing):
+            log.error('Stream dependency does not exist in the database: %s', depend_id)
+
+        for source_id, product_id in sorted(added):
+            sd = StreamDependency()
+            sd.source_stream_id = source_id
+            sd.product_stream_id = product_id
+            session.add(sd)
+
+        for pair in sorted(removed):
+            session.delete(depends[pair])
+
+        checkpoint(session, hashes, batch, batch_size)
 
+    hashes.save()
     session.commit()
+    return len(csv_depends)
 
 
 def process_bin_sizes():
@@ -350,77 +634,109 @@ def process_bin_sizes():
     return bin_size_dict
 
 
-def parse_refdes(refdes):
-    try:
-        subsite, node, sensor = refdes.split('-', 2)
-    except StandardError:
-        subsite = node = sensor = None
-    return subsite, node, sensor
-
-
-def process_nominal_depths(session):
+def nominal_depth_frame(dataframe):
+    """
+    Parse the rows of nominal_depths.csv with vectorized operations into a DataFrame indexed by reference
+    designator, with the subsite, node, sensor and integer depth of each and whether the row is valid.
+    Rows without a designator or depth are dropped. Rows whose designator is not a complete instrument
+    reference designator (subsite-node-sensor) or whose depth is not a number are not valid, the latter
+    are logged.
+    """
+    data = dataframe.dropna(how='any').drop_duplicates('designator', keep='last')
+    parts = data.designator.str.extract(r'^([^-]+)-([^-]+)-(.+)$', expand=True)
+    depth = pd.to_numeric(data.depth, errors='coerce')
+    for refdes, value in zip(data.designator[depth.isnull()], data.depth[depth.isnull()]):
+        log.error('Error processing nominal depth %r: %r', refdes, value)
+
+    frame = pd.DataFrame({'subsite': parts[0], 'node': parts[1], 'sensor': parts[2],
+                          'depth': np.trunc(depth.fillna(0)).astype(np.int64),
+                          'valid': parts.notnull().all(axis=1) & depth.notnull()},
+                         columns=['subsite', 'node', 'sensor', 'depth', 'valid'])
+    frame.index = data.designator.values
+    return frame
+
+
+def nominal_depth_values(frame):
+    # Column values of the valid rows of a nominal_depth_frame, by reference designator
+    frame = frame[frame.valid]
+    columns = ['subsite', 'node', 'sensor', 'depth']
+    return {refdes: dict(zip(columns, values)) for refdes, values in
+            zip(frame.index, zip(*[frame[column].tolist() for column in columns]))}
+
+
+def process_nominal_depths(session, full=False, batch_size=None):
+    """
+    Apply nominal_depths.csv by comparing it with the nominal_depth table in bulk. Rows in both are
+    only updated if their row hash changed since they were last applied (or full) and the depth differs.
+    """
     log.info('Processing nominal depths data')
-
-    # Read the dataframe, drop all records without a depth or if the depth column contains 'VAR'
-    dataframe = pd.read_csv(os.path.join(CSV_DIR, 'nominal_depths.csv'))
-    dataframe.dropna(how='any', inplace=True)
-
-    # fetch the current nominal depths as dictionary
-    all_nominals = {nd.reference_designator: nd for nd in session.query(NominalDepth)}
-
-    csv_nominals = {refdes: depth for _, refdes, depth in dataframe.itertuples()}
-    new_nominals = set(csv_nominals).difference(all_nominals)
-    update_nominals = set(csv_nominals).difference(new_nominals)
-    delete_nominals = set(all_nominals).difference(csv_nominals)
-
-    # update all existing records in this session
-    for refdes in update_nominals:
-        depth = csv_nominals[refdes]
-        nd = all_nominals[refdes]
-        nd.depth = int(float(depth))
-
-    # delete any expired nominals
-    for refdes in delete_nominals:
-        session.delete(all_nominals[refdes])
-
-    # create any new nominal depth records
-    for refdes in sorted(new_nominals):
-        depth = csv_nominals[refdes]
-        try:
-            depth = int(float(depth))
-            subsite, node, sensor = parse_refdes(refdes)
-            if all((subsite, node, sensor)):
-                nd = NominalDepth(subsite=subsite, node=node, sensor=sensor, depth=depth)
-                session.add(nd)
-        except ValueError:
-            log.error('Error processing nominal depth %r: %r', refdes, depth)
-
+    table = NominalDepth.__table__
+    csv_nominals = nominal_depth_frame(dataframes['nominal_depths'])
+    valid = csv_nominals[csv_nominals.valid]
+    hashes = RowHashes(session, 'nominal_depths', full)
+    changed = pd.Series([hashes.changed(refdes, depth) for refdes, depth in zip(valid.index, valid.depth.tolist())],
+                        index=valid.index, dtype=bool)
+
+    columns = ['id', 'subsite', 'node', 'sensor', 'depth']
+    existing = pd.DataFrame(session.execute(select([table.c[column] for column in columns])).fetchall(),
+                            columns=columns)
+    existing.index = existing.subsite + '-' + existing.node + '-' + existing.sensor
+
+    # existing rows whose CSV row is invalid are kept
+    new_nominals = valid.loc[valid.index.difference(existing.index)]
+    delete_nominals = existing.loc[existing.index.difference(csv_nominals.index)]
+    common = valid.index[changed.values].intersection(existing.index)
+    update_nominals = valid.loc[common][valid.depth[common].values != existing.depth[common].values]
+    log.info('Nominal depths new: %d changed: %d deleted: %d',
+             len(new_nominals), len(update_nominals), len(delete_nominals))
+
+    size = batch_size or max(len(new_nominals), len(update_nominals), len(delete_nominals), 1)
+    for ids in chunks(delete_nominals.id.tolist(), size):
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+        checkpoint(session, hashes, [], batch_size)
+
+    update = table.update().where(table.c.id == bindparam('nominal_id')).values(depth=bindparam('new_depth'))
+    updates = zip(update_nominals.index, existing.id[update_nominals.index].tolist(), update_nominals.depth.tolist())
+    for rows in chunks(updates, size):
+        session.execute(update, [{'nominal_id': nominal_id, 'new_depth': depth} for _, nominal_id, depth in rows])
+        checkpoint(session, hashes, [refdes for refdes, _, _ in rows], batch_size)
+
+    for rows in chunks(sorted(nominal_depth_values(new_nominals).items()), size):
+        session.execute(table.insert(), [values for _, values in rows])
+        checkpoint(session, hashes, [refdes for refdes, _ in rows], batch_size)
+
+    hashes.save()
     session.commit()
+    return len(new_nominals) + len(update_nominals) + len(delete_nominals)
 
 
-def process_value_table(session, dataframe, name, klass):
-    all_values = {item.value: item.id for item in session.query(klass)}
-    csv_values = set()
-
-    for val in dataframe[name]:
+def iter_value_table_values(column):
+    # Each value in a CSV column, a value may be a single string or a JSON list of strings
+    for val in column:
         if val is None:
             continue
         try:
             val_list = json.loads(val)
             if isinstance(val_list, list):
                 for each in val_list:
-                    csv_values.add(each)
+                    yield each
                 continue
-            csv_values.add(val)
+            yield val
         except ValueError:
-            csv_values.add(val)
-    new_values = csv_values.difference(all_values)
+            yield val
 
-    for each in sorted(new_values):
-        new_item = klass(value=each)
-        session.add(new_item)
+
+def process_value_table(session, dataframe, name, klass):
+    all_values = {item.value: item.id for item in session.query(klass)}
+    csv_values = set(iter_value_table_values(dataframe[name]))
+    new_values = sorted(csv_values.difference(all_values))
+
+    if new_values:
+        # Insert in sorted order, as one statement, so ids are assigned in the same order as before
+        session.execute(klass.__table__.insert(), [{'value': each} for each in new_values])
+        for item_id, value in query_by_ids(session.query(klass.id, klass.value), klass.value, new_values):
+            all_values[value] = item_id
         session.commit()
-        all_values[each] = new_item.id
 
     return all_values
 
@@ -431,35 +747,695 @@ def process_value_table_map(session, framename):
     return {name: process_value_table(session, dataframe, name, value_map[name]) for name in value_map}
 
 
-def read_csv_data():
+def read_csv_file(csv_file):
+    """
+    Read the columns of a CSV file used by the loader in one pass and drop its DOC rows.
+
+    All columns are read as text, those in CSV_NUMERIC_COLUMNS are then converted to numbers.
+    Missing values are None.
+    """
+    filename = '%s.csv' % csv_file
+    filepath = os.path.join(CSV_DIR, filename)
+    log.info('Reading %s', filename)
+    df = pd.read_csv(filepath, encoding='utf-8', usecols=CSV_COLUMNS[csv_file], dtype=object)
+    if 'scenario' in df:
+        df = df[np.logical_not(df.scenario.str.startswith('DOC').fillna(False))]
+
+    # Every column is text, so the values are one block which can be changed in place rather than
+    # copying the frame with df.where
+    values = df.values
+    values[pd.isnull(values)] = None
+    for column in CSV_NUMERIC_COLUMNS.intersection(df.columns):
+        number = pd.to_numeric(df[column], errors='coerce')
+        df[column] = number.astype(object).where(number.notnull(), None)
+    return df
+
+
+def log_validation(report):
+    # Log the checks of a validate_preload report which failed, the rows are still applied if they are loadable
+    for check in report['checks']:
+        if check['errors']:
+            ids = sorted({error['id'] for error in report['errors']
+                          if (error['check'], error['file']) == (check['check'], check['file'])})
+            log.warning('%s %s: %s (%d errors: %s)', check['file'], check['column'], check['rule'],
+                        check['errors'], ', '.join(ids[:10]) + (', ...' if len(ids) > 10 else ''))
+
+
+def read_csv_data(threads=None):
+    # Read the CSV files in parallel threads, the parser releases the GIL while tokenizing. By default
+    # one thread per CPU, on a single CPU parsing the files at once only raises the peak memory.
+    pool = ThreadPool(threads or min(len(CSV_FILES), cpu_count()))
+    try:
+        for csv_file, df in zip(CSV_FILES, pool.map(read_csv_file, CSV_FILES)):
+            dataframes[csv_file] = df
+    finally:
+        pool.close()
+
+
+class StageProfile(object):
+    """
+    Record the wall time, rows applied, SQL statements executed and ORM objects flushed by each stage of a load.
+
+    Statements are counted on the engine (an executemany counts once) and flushed objects are the new,
+    changed and deleted objects of each flush of session.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.engine = session.get_bind()
+        self.stages = []
+        self.statements = 0
+        self.flushed = 0
+        event.listen(self.engine, 'before_cursor_execute', self.count_statement)
+        event.listen(self.session, 'after_flush', self.count_flushed)
+
+    def count_statement(self, *args):
+        self.statements += 1
+
+    def count_flushed(self, session, flush_context):
+        self.flushed += len(session.new) + len(session.dirty) + len(session.deleted)
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'rows': None}
+        start_statements = self.statements
+        start_flushed = self.flushed
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.time() - start, 6)
+            record['statements'] = self.statements - start_statements
+            record['flushed'] = self.flushed - start_flushed
+            self.stages.append(record)
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count_statement)
+        event.remove(self.session, 'after_flush', self.count_flushed)
+
+    def report(self):
+        total = {'stage': 'total'}
+        for field in ['seconds', 'rows', 'statements', 'flushed']:
+            total[field] = sum(stage[field] or 0 for stage in self.stages)
+        return {'stages': self.stages, 'total': total}
+
+
+@contextmanager
+def profile_stage(profile, name):
+    # Record a stage of update_db in profile, yields the record so the stage can add its row count
+    if profile is None:
+        yield {}
+    else:
+        with profile.stage(name) as record:
+            yield record
+
+
+def copy_text(value):
+    # Format a value for COPY ... FROM STDIN in Postgres text format
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf8')
+    return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+
+def stage_rows(session, table, columns, rows):
+    """
+    COPY rows (sequences of values for columns) into a temporary table with the columns of table.
+
+    Values are converted with the bind processors of the table's column types, as the ORM would.
+    The staging table is dropped when the transaction ends. Returns its name.
+    """
+    stage = 'stage_%s' % table.name
+    column_list = ', '.join('"%s"' % column for column in columns)
+    session.execute('CREATE TEMP TABLE %s ON COMMIT DROP AS SELECT %s FROM "%s" WITH NO DATA' %
+                    (stage, column_list, table.name))
+
+    dialect = session.get_bind().dialect
+    processors = [table.c[column].type.bind_processor(dialect) for column in columns]
+    data = io.BytesIO()
+    for row in rows:
+        fields = [copy_text(value if processor is None or value is None else processor(value))
+                  for value, processor in zip(row, processors)]
+        data.write((u'\t'.join(fields) + u'\n').encode('utf8'))
+    data.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (stage, column_list), data)
+    return stage
+
+
+def upsert_staged(session, table, stage, columns, key, keep_existing=(), condition='TRUE'):
+    """
+    Insert the staged rows matching condition into table, updating rows whose key already exists if
+    any column differs.
+
+    Columns in keep_existing keep their current value when the staged value is NULL.
+    """
+    quoted = ['"%s"' % column for column in columns]
+    current = []
+    updates = []
+    for column in columns:
+        if column in key:
+            continue
+        new = 'EXCLUDED."%s"' % column
+        if column in keep_existing:
+            new = 'COALESCE(%s, "%s"."%s")' % (new, table.name, column)
+        current.append('"%s"."%s"' % (table.name, column))
+        updates.append(('"%s"' % column, new))
+
+    sql = ('INSERT INTO "%s" (%s) SELECT %s FROM %s WHERE %s ON CONFLICT (%s) DO UPDATE SET %s '
+           'WHERE (%s) IS DISTINCT FROM (%s)') % (
+        table.name, ', '.join(quoted), ', '.join(quoted), stage, condition, ', '.join('"%s"' % k for k in key),
+        ', '.join('%s = %s' % update for update in updates),
+        ', '.join(current), ', '.join(new for _, new in updates))
+    return session.execute(sql).rowcount
+
+
+def delete_unstaged(session, table, stage, key, condition='TRUE'):
+    # Delete the rows of table matching condition whose key is not in the staging table
+    match = ' AND '.join('s."%s" = t."%s"' % (k, k) for k in key)
+    sql = 'DELETE FROM "%s" t WHERE %s AND NOT EXISTS (SELECT 1 FROM %s s WHERE %s)' % (
+        table.name, condition, stage, match)
+    return session.execute(sql).rowcount
+
+
+def bulk_nominal_depths(session):
+    log.info('Bulk loading nominal depths')
+    table = NominalDepth.__table__
+    columns = ['subsite', 'node', 'sensor', 'depth']
+    frame = nominal_depth_frame(dataframes['nominal_depths'])
+    hashes = RowHashes(session, 'nominal_depths', full=True)
+    for refdes, values in nominal_depth_values(frame).items():
+        hashes.changed(refdes, values['depth'])
+
+    # Rows whose depth is invalid are staged without one, so the existing row is kept as by update_db
+    frame = frame[frame[['subsite', 'node', 'sensor']].notnull().all(axis=1)].sort_index()
+    rows = [[subsite, node, sensor, depth if valid else None] for subsite, node, sensor, depth, valid in
+            zip(*[frame[column].tolist() for column in columns + ['valid']])]
+
+    key = ['subsite', 'node', 'sensor']
+    stage = stage_rows(session, table, columns, rows)
+    upserted = upsert_staged(session, table, stage, columns, key, condition='depth IS NOT NULL')
+    deleted = delete_unstaged(session, table, stage, key)
+    log.info('Nominal depths inserted or updated: %d deleted: %d', upserted, deleted)
+
+    hashes.save()
+    session.commit()
+    return upserted + deleted
+
+
+def bulk_parameters(session):
+    log.info('Bulk loading parameters')
+    name = 'ParameterDefs'
+    value_table_map = process_value_table_map(session, name)
+    hashes = RowHashes(session, name, full=True)
+
+    csv_params = {}
+    csv_dimensions = {}
+    for row in loadable_rows(dataframes[name], 'ParameterDefs').itertuples(index=False):
+        parameter_id = int(row.id[2:])
+        hashes.changed(parameter_id, row)
+        csv_params[parameter_id] = parameter_values(parameter_id, row, value_table_map)
+        csv_dimensions[parameter_id] = parameter_dimension_ids(row, value_table_map)
+
+    table = Parameter.__table__
+    columns = sorted(csv_params.values()[0]) if csv_params else ['id']
+    stage = stage_rows(session, table, columns,
+                       [[values[column] for column in columns] for _, values in sorted(csv_params.items())])
+    upserted = upsert_staged(session, table, stage, columns, ['id'], PARAMETER_OPTIONAL_COLUMNS)
+
+    # Only parameters which specify their dimensions have them replaced, an empty
+    # dimension marks a parameter which specifies that it has no dimensions
+    dimension_table = Parameter.dimensions.property.secondary
+    dimension_rows = []
+    for parameter_id, dimension_ids in sorted(csv_dimensions.items()):
+        if dimension_ids is not None:
+            dimension_rows.append([parameter_id, None])
+            dimension_rows.extend([parameter_id, dim] for dim in sorted(dimension_ids) if dim is not None)
+    dimension_stage = stage_rows(session, dimension_table, ['parameter_id', 'dimension_id'], dimension_rows)
+    session.execute('INSERT INTO "%s" (parameter_id, dimension_id) SELECT parameter_id, dimension_id FROM %s '
+                    'WHERE dimension_id IS NOT NULL ON CONFLICT DO NOTHING' % (dimension_table.name, dimension_stage))
+    delete_unstaged(session, dimension_table, dimension_stage, ['parameter_id', 'dimension_id'],
+                    't.parameter_id IN (SELECT parameter_id FROM %s)' % dimension_stage)
+
+    # Remove the associations of deleted parameters, then the parameters
+    condition = 't.parameter_id NOT IN (SELECT id FROM %s)' % stage
+    for association in [dimension_table, Stream.parameters.property.secondary]:
+        session.execute('DELETE FROM "%s" t WHERE %s' % (association.name, condition))
+    deleted = delete_unstaged(session, table, stage, ['id'])
+    log.info('Parameters inserted or updated: %d deleted: %d', upserted, deleted)
+
+    hashes.save()
+    session.commit()
+    return upserted + deleted
+
+
+def bulk_streams(session):
+    log.info('Bulk loading streams')
+    name = 'ParameterDictionary'
+    value_table_map = process_value_table_map(session, name)
+    bin_sizes = process_bin_sizes()
+    parameter_ids = {parameter_id for parameter_id, in session.query(Parameter.id)}
+    hashes = RowHashes(session, name, full=True)
+
+    csv_streams = {}
+    csv_params = {}
+    for row in loadable_rows(dataframes[name], 'ParameterDictionary').itertuples(index=False):
+        stream_id = int(row.id[4:])
+        params = parse_ids(row.parameterids, 'PD')
+        hashes.changed(stream_id, row, bin_sizes.get(row.name), sorted(parameter_ids.intersection(params)))
+        csv_streams[stream_id] = stream_values(stream_id, row, value_table_map, bin_sizes)
+        csv_params[stream_id] = set(params)
+
+    table = Stream.__table__
+    columns = sorted(csv_streams.values()[0]) if csv_streams else ['id']
+    stage = stage_rows(session, table, columns,
+                       [[values[column] for column in columns] for _, values in sorted(csv_streams.items())])
+    upserted = upsert_staged(session, table, stage, columns, ['id'])
+
+    # Link each stream to those of its parameters which exist
+    parameter_table = Stream.parameters.property.secondary
+    parameter_stage = stage_rows(session, parameter_table, ['stream_id', 'parameter_id'],
+                                 [[stream_id, parameter_id] for stream_id, params in sorted(csv_params.items())
+                                  for parameter_id in sorted(params.intersection(parameter_ids))])
+    session.execute('INSERT INTO "%s" (stream_id, parameter_id) SELECT stream_id, parameter_id FROM %s '
+                    'ON CONFLICT DO NOTHING' % (parameter_table.name, parameter_stage))
+    delete_unstaged(session, parameter_table, parameter_stage, ['stream_id', 'parameter_id'])
+
+    # Remove the dependencies of deleted streams, then the streams
+    session.execute('DELETE FROM "%s" WHERE source_stream_id NOT IN (SELECT id FROM %s) '
+                    'OR product_stream_id NOT IN (SELECT id FROM %s)' % (StreamDependency.__tablename__, stage, stage))
+    deleted = delete_unstaged(session, table, stage, ['id'])
+    log.info('Streams inserted or updated: %d deleted: %d', upserted, deleted)
+
+    hashes.save()
+    session.commit()
+    return upserted + deleted
+
+
+def bulk_stream_dependencies(session):
+    log.info('Bulk loading stream dependencies')
+    name = 'ParameterDictionary'
+    stream_ids = {stream_id for stream_id, in session.query(Stream.id)}
+    hashes = RowHashes(session, 'StreamDependency', full=True)
+
+    # An empty source marks a stream whose dependencies are all removed
+    rows = []
+    for row in loadable_rows(dataframes[name], 'ParameterDictionary').itertuples(index=False):
+        stream_id = int(row.id[4:])
+        if stream_id in stream_ids:
+            depend_ids = parse_ids(row.streamdependency, 'DICT')
+            hashes.changed(stream_id, depend_ids, sorted(stream_ids.intersection(depend_ids)))
+            rows.append([None, stream_id])
+            for depend_id in depend_ids:
+                if depend_id in stream_ids:
+                    rows.append([depend_id, stream_id])
+                else:
+                    log.error('Stream dependency does not exist in the database: %s', depend_id)
+
+    table = StreamDependency.__table__
+    key = ['source_stream_id', 'product_stream_id']
+    stage = stage_rows(session, table, key, rows)
+    inserted = session.execute('INSERT INTO "%s" (source_stream_id, product_stream_id) '
+                               'SELECT source_stream_id, product_stream_id FROM %s '
+                               'WHERE source_stream_id IS NOT NULL ON CONFLICT DO NOTHING' % (table.name, stage)).rowcount
+    deleted = delete_unstaged(session, table, stage, key,
+                              't.product_stream_id IN (SELECT product_stream_id FROM %s)' % stage)
+    log.info('Stream dependencies inserted: %d deleted: %d', inserted, deleted)
+
+    hashes.save()
+    session.commit()
+    return inserted + deleted
+
+
+def update_db_bulk(session, profile=None):
+    """
+    Apply the CSV data to a Postgres database in bulk.
+
+    The rows of each table are staged with COPY and applied with INSERT ... ON CONFLICT DO UPDATE
+    and set-based deletes instead of through the ORM. Every row is applied and the row hashes are
+    rebuilt, as with update_db(session, full=True). Each stage is committed once, there are no
+    batches. Statements issued by COPY are not counted by a StageProfile.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect != 'postgresql':
+        raise ValueError('Bulk loading requires a PostgreSQL database, not %s' % dialect)
+
+    database.preload_row_hash.create(bind=session.get_bind(), checkfirst=True)
+    stages = [
+        ('nominal_depths', bulk_nominal_depths),
+        ('parameter_funcs', lambda s: process_parameter_funcs(s, full=True)),
+        ('parameters', bulk_parameters),
+        ('streams', bulk_streams),
+        ('stream_dependencies', bulk_stream_dependencies),
+    ]
+    for name, stage in stages:
+        with profile_stage(profile, name) as record:
+            record['rows'] = stage(session)
+
+
+def update_db(session, full=False, profile=None, stages=None, batch_size=None):
+    """
+    Apply the CSV data to the database.
+
+    :param full: apply every row, rather than only the rows changed since they were last applied
+    :param profile: StageProfile recording each stage, or None
+    :param stages: names of the stages to apply (see STAGE_FILES), or None for all of them
+    :param batch_size: commit the changed rows of each stage in batches of this many rows, with their
+                       row hashes, so an interrupted load resumes after the last batch. If None each
+                       stage is committed once.
+    """
+    database.preload_row_hash.create(bind=session.get_bind(), checkfirst=True)
+    all_stages = [
+        ('nominal_depths', process_nominal_depths),
+        ('parameter_funcs', process_parameter_funcs),
+        ('parameters', process_parameters),
+        ('streams', process_streams),
+        ('stream_dependencies', process_stream_dependencies),
+    ]
+    for name, stage in all_stages:
+        if stages is None or name in stages:
+            with profile_stage(profile, name) as record:
+                record['rows'] = stage(session, full, batch_size)
+
+
+def load_target(url, full=False, bulk=False, batch_size=None, profile=False):
+    """
+    Apply the CSV data already read to the database at url, with its own engine and session.
+
+    Errors are logged and reported rather than raised. Returns a dict with the target (the URL
+    without its password), whether the load succeeded, its wall time, the error if it failed
+    and the StageProfile report if profile is set.
+    """
+    # A malformed URL is reported as a failed load, with its password masked as make_url would
+    target = re.sub(r'^((?:[^:/@]*://)?[^:/@]*:)[^@]*@', r'\1***@', url)
+    report = {'target': target, 'ok': False}
+    start = time.time()
+    engine = session = stage_profile = None
+    try:
+        target = report['target'] = repr(make_url(url))
+        engine = database.create_engine_from_url(url)
+        session = database.create_scoped_session(engine)()
+        stage_profile = StageProfile(session) if profile else None
+        if bulk:
+            update_db_bulk(session, stage_profile)
+        else:
+            update_db(session, full, stage_profile, batch_size=batch_size)
+        database.create_preload_indexes(engine)
+        report['ok'] = True
+    except Exception as e:
+        if session is not None:
+            session.rollback()
+        log.exception('Error loading %s', target)
+        report['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        if stage_profile is not None:
+            stage_profile.close()
+            report['profile'] = stage_profile.report()
+        if session is not None:
+            session.close()
+        if engine is not None:
+            engine.dispose()
+        report['seconds'] = round(time.time() - start, 3)
+    log.info('%s %s in %.2fs', 'Loaded' if report['ok'] else 'Failed to load', target, report['seconds'])
+    return report
+
+
+def load_targets(urls, full=False, bulk=False, batch_size=None, profile=False):
+    """
+    Apply the CSV data already read to each of the databases at urls concurrently, one thread per
+    database. Each database is compared with the CSV data (and its own row hashes) separately.
+    Returns the load_target report of each, in the order of urls.
+    """
+    pool = ThreadPool(len(urls))
+    try:
+        return pool.map(lambda url: load_target(url, full, bulk, batch_size, profile), urls)
+    finally:
+        pool.close()
+
+
+def changed_stages(changed_files):
+    # Names of the stages of update_db which read any of the changed CSV files, in order
+    return [name for name, files in STAGE_FILES if files.intersection(changed_files)]
+
+
+def csv_mtimes():
+    """Modification time of each CSV file read by the loader, by name, None if the file is missing"""
+    mtimes = {}
     for csv_file in CSV_FILES:
-        filename = '%s.csv' % csv_file
-        filepath = os.path.join(CSV_DIR, filename)
-        log.info('Reading %s', filename)
-        df = pd.read_csv(filepath, encoding='utf-8')
-        if 'scenario' in df:
-            df = df[np.logical_not(df.scenario.str.startswith('DOC').fillna(False))]
-        dataframes[csv_file] = df.where(pd.notnull(df), None)
+        try:
+            mtimes[csv_file] = os.path.getmtime(os.path.join(CSV_DIR, '%s.csv' % csv_file))
+        except OSError:
+            mtimes[csv_file] = None
+    return mtimes
+
+
+def watch(apply, interval=1.0):
+    """
+    Poll the CSV files until interrupted, re-reading those which change and calling apply(stages)
+    with the names of the stages of update_db which read them.
+
+    A change is only picked up once the modification times are unchanged for one interval, so a
+    file is not read while it is being saved. If reading or applying a change fails the error is
+    logged and the files are not read again until they next change.
+    """
+    applied = previous = csv_mtimes()
+    while True:
+        time.sleep(interval)
+        current = csv_mtimes()
+        if current == applied or current != previous:
+            previous = current
+            continue
+
+        changed = {name for name in current if current[name] != applied[name]}
+        applied = current
+        log.info('Changed: %s', ', '.join(sorted(changed)))
+        try:
+            for csv_file in changed.intersection(CSV_FILES):
+                dataframes[csv_file] = read_csv_file(csv_file)
+            parsed_dimensions.clear()
+            log_validation(validate_catalog(dataframes))
+            apply(changed_stages(changed))
+        except Exception:
+            log.exception('Error applying changes to %s', ', '.join(sorted(changed)))
+
+
+# Columns referencing value tables, compared and reported by value rather than id in changesets
+VALUE_TABLE_COLUMNS = {
+    'parameter': {'parameter_type_id': 'parametertype', 'value_encoding_id': 'valueencoding',
+                  'code_set_id': 'codeset', 'unit_id': 'unitofmeasure', 'fill_value_id': 'fillvalue',
+                  'data_product_type_id': 'dataproducttype'},
+    'parameter_function': {'function_type_id': 'functiontype'},
+    'stream': {'stream_type_id': 'streamtype', 'stream_content_id': 'streamcontent'},
+}
+
 
+def diff_rows(existing, csv, keep_existing=()):
+    """
+    Compare the rows currently in a table with the rows from the CSV files.
+
+    :param existing: current column values of each row, by key
+    :param csv: column values of each row from the CSV files, by key
+    :param keep_existing: columns which are not changed when the CSV value is None
+    :return: dict of inserted rows, updated rows (key and {column: [old, new]}) and deleted keys
+    """
+    updates = []
+    for key in sorted(set(existing).intersection(csv)):
+        changes = {}
+        for column, value in csv[key].items():
+            old = existing[key].get(column)
+            if value != old and not (value is None and column in keep_existing):
+                changes[column] = [old, value]
+        if changes:
+            updates.append({'key': key, 'changes': changes})
+    return {
+        'insert': [csv[key] for key in sorted(set(csv).difference(existing))],
+        'update': updates,
+        'delete': sorted(set(existing).difference(csv)),
+    }
+
+
+def diff_pairs(existing, csv):
+    # Compare the rows of an association table, as sets of tuples
+    return {
+        'insert': sorted(set(csv).difference(existing)),
+        'update': [],
+        'delete': sorted(set(existing).difference(csv)),
+    }
+
+
+def read_table(session, table, key='id', value_maps=None):
+    """Read the rows of table by key, replacing value table ids with their values"""
+    values = {}
+    columns = VALUE_TABLE_COLUMNS.get(table.name, {})
+    for row in session.execute(table.select()):
+        row = dict(row)
+        for column, name in columns.items():
+            row[column] = value_maps[name].get(row[column])
+        values[key(row) if callable(key) else row[key]] = row
+    return values
+
+
+def compute_changeset(session):
+    """
+    Compute the changes update_db would make to the database, without changing it.
+
+    Only the existing rows are read. Value table references are compared and reported
+    by value, since new values do not have ids until they are inserted.
+    """
+    changeset = {}
+
+    # Value tables: new values are inserted, existing values are never changed
+    value_maps = {}
+    id_maps = {}
+    for framename, value_map in value_table_map_map.items():
+        dataframe = dataframes[framename]
+        for name, klass in value_map.items():
+            existing = dict(session.query(klass.id, klass.value))
+            csv_values = set(iter_value_table_values(dataframe[name]))
+            value_maps[name] = {value: value for value in csv_values.union(existing.values())}
+            id_maps[name] = existing
+            changeset[klass.__tablename__] = {'insert': sorted(csv_values.difference(existing.values())),
+                                              'update': [], 'delete': []}
+
+    nominal_frame = nominal_depth_frame(dataframes['nominal_depths'])
+    csv_nominals = nominal_depth_values(nominal_frame)
+    existing = read_table(session, NominalDepth.__table__, lambda row: '-'.join((row['subsite'], row['node'],
+                                                                                 row['sensor'])))
+    # existing rows whose CSV row is invalid are kept
+    for refdes in nominal_frame.index[~nominal_frame.valid]:
+        existing.pop(refdes, None)
+    for row in existing.values():
+        del row['id']
+    changeset['nominal_depth'] = diff_rows(existing, csv_nominals)
+
+    csv_functions = {}
+    for row in loadable_rows(dataframes['ParameterFunctions'], 'ParameterFunctions').itertuples(index=False):
+        func_id = int(row.id[4:])
+        csv_functions[func_id] = parameter_function_values(func_id, row, value_maps)
+    changeset['parameter_function'] = diff_rows(read_table(session, ParameterFunction.__table__, value_maps=id_maps),
+                                                csv_functions)
+
+    csv_params = {}
+    csv_dimensions = {}
+    for row in loadable_rows(dataframes['ParameterDefs'], 'ParameterDefs').itertuples(index=False):
+        parameter_id = int(row.id[2:])
+        csv_params[parameter_id] = parameter_values(parameter_id, row, value_maps)
+        csv_dimensions[parameter_id] = parameter_dimension_ids(row, value_maps)
+    changeset['parameter'] = diff_rows(read_table(session, Parameter.__table__, value_maps=id_maps),
+                                       csv_params, PARAMETER_OPTIONAL_COLUMNS)
+
+    # Dimensions are only replaced for parameters which specify them, deleted parameters lose theirs
+    dimension_table = Parameter.dimensions.property.secondary
+    existing = {(parameter_id, id_maps['dimensions'].get(dimension_id))
+                for parameter_id, dimension_id in session.execute(dimension_table.select())}
+    csv_pairs = {(parameter_id, dimension) for parameter_id, dimensions in csv_dimensions.items()
+                 if dimensions is not None for dimension in dimensions if dimension is not None}
+    csv_pairs.update(pair for pair in existing if pair[0] in csv_dimensions and csv_dimensions[pair[0]] is None)
+    changeset[dimension_table.name] = diff_pairs(existing, csv_pairs)
+
+    bin_sizes = process_bin_sizes()
+    csv_streams = {}
+    csv_stream_params = set()
+    csv_depends = {}
+    for row in loadable_rows(dataframes['ParameterDictionary'], 'ParameterDictionary').itertuples(index=False):
+        stream_id = int(row.id[4:])
+        csv_streams[stream_id] = stream_values(stream_id, row, value_maps, bin_sizes)
+        csv_stream_params.update((stream_id, parameter_id) for parameter_id in parse_ids(row.parameterids, 'PD')
+                                 if parameter_id in csv_params)
+        csv_depends[stream_id] = parse_ids(row.streamdependency, 'DICT')
+    changeset['stream'] = diff_rows(read_table(session, Stream.__table__, value_maps=id_maps), csv_streams)
+
+    parameter_table = Stream.parameters.property.secondary
+    existing = {tuple(row) for row in session.execute(parameter_table.select())}
+    changeset[parameter_table.name] = diff_pairs(existing, csv_stream_params)
 
-def update_db(session):
-    process_nominal_depths(session)
-    process_parameter_funcs(session)
-    process_parameters(session)
-    process_streams(session)
-    process_stream_dependencies(session)
+    depend_table = StreamDependency.__table__
+    existing = {(row.source_stream_id, row.product_stream_id) for row in session.execute(depend_table.select())}
+    csv_pairs = {(source_id, product_id) for product_id, depend_ids in csv_depends.items()
+                 for source_id in depend_ids if source_id in csv_streams}
+    changeset[depend_table.name] = diff_pairs(existing, csv_pairs)
+
+    return changeset
 
 
 if __name__ == '__main__':
     options = docopt.docopt(__doc__)
-    url = options['<url>']
+    urls = options['<url>']
+    url = urls[0] if urls else None
+    compression = options['--compress']
+    if compression not in (None, 'gzip', 'xz'):
+        raise docopt.DocoptExit('Unsupported compression: %s' % compression)
+    batch_size = options['--batch-size']
+    if batch_size is not None:
+        if not batch_size.isdigit() or int(batch_size) < 1:
+            raise docopt.DocoptExit('Invalid batch size: %s' % batch_size)
+        batch_size = int(batch_size)
 
     read_csv_data()
+    log_validation(validate_catalog(dataframes))
+
+    if len(urls) > 1:
+        reports = load_targets(urls, options['--full'], options['--bulk'], batch_size, bool(options['--profile']))
+        if options['--profile']:
+            with open(options['--profile'], 'w') as fh:
+                # targets which failed before their profile was created have none
+                profiles = {report['target']: report.pop('profile', None) for report in reports}
+                json.dump({target: profile for target, profile in profiles.items() if profile is not None}, fh,
+                          indent=2, sort_keys=True)
+        print json.dumps(reports, indent=2, sort_keys=True)
+        sys.exit(0 if all(report['ok'] for report in reports) else 1)
 
     engine = database.create_engine_from_url(url)
     Session = database.create_scoped_session(engine)
     session = Session()
-    update_db(session)
 
-    if not url:
-        database.generate_script_from_preload_database(engine.raw_connection().connection)
+    def write_script():
+        database.generate_script_from_preload_database(engine.raw_connection().connection,
+                                                       compression=compression)
+
+    def apply_changes(stages):
+        start = time.time()
+        if url:
+            changeset = compute_changeset(session)
+            print json.dumps({table: changes for table, changes in changeset.items() if any(changes.values())},
+                             sort_keys=True)
+            sys.stdout.flush()
+        try:
+            update_db(session, stages=stages)
+        except Exception:
+            session.rollback()
+            raise
+        if not url:
+            write_script()
+        log.info('Applied %s in %.2fs', ', '.join(stages), time.time() - start)
+
+    if options['--dry-run']:
+        try:
+            print json.dumps(compute_changeset(session), indent=2, sort_keys=True)
+        finally:
+            session.rollback()
+    else:
+        profile = StageProfile(session) if options['--profile'] else None
+        if options['--bulk']:
+            update_db_bulk(session, profile)
+        else:
+            update_db(session, options['--full'], profile, batch_size=batch_size)
+        database.create_preload_indexes(engine)
+
+        if profile is not None:
+            profile.close()
+            with open(options['--profile'], 'w') as fh:
+                json.dump(profile.report(), fh, indent=2, sort_keys=True)
+
+        if not url:
+            write_script()
+
+        if options['--watch']:
+            log.info('Watching %s', CSV_DIR)
+            try:
+                watch(apply_changes, float(options['--interval']))
+            except KeyboardInterrupt:
+                pass
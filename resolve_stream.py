@@ -13,17 +13,15 @@ from exceptions import NameError, UserWarning
 import yaml
 import pickle
 
-from ooi_data.postgres.model import *
 from tools.m2m import MachineToMachine
-from database import create_engine_from_url, create_scoped_session
+from catalog import create_catalog
 
 
 QualifiedParameter = namedtuple('QualifiedParameter', 'parameter refdes method stream')
 
-engine = create_engine_from_url(None)
-session = create_scoped_session(engine)
+PRELOAD_TABLES = ['parameter', 'parameter_type', 'stream', 'stream_parameter', 'nominal_depth']
 
-MetadataBase.query = session.query_property()
+catalog = create_catalog(tables=PRELOAD_TABLES)
 indent = '  '
 
 
@@ -39,7 +37,7 @@ def stream_exists(refdes, method, stream, stream_map):
 
 
 def has_functions(stream):
-    s = Stream.query.filter(Stream.name == stream).first()
+    s = catalog.get_stream_by_name(stream)
     return bool(s.derived)
 
 
@@ -47,7 +45,7 @@ def make_parameter_map(instruments, method, stream_map):
     parameter_map = {}
     for rd in instruments:
         for stream in stream_map.get(rd, {}).get(method, []):
-            s = Stream.query.filter(Stream.name == stream).first()
+            s = catalog.get_stream_by_name(stream)
             for p in s.parameters:
                 parameter_map.setdefault(p.id, set()).add((rd, stream))
     return parameter_map
@@ -63,7 +61,7 @@ def same_node(refdes, m2m):
 
 def get_collocated(refdes):
     subsite, node, sensor = refdes.split('-', 2)
-    nominal_depth = NominalDepth.get_nominal_depth(subsite, node, sensor)
+    nominal_depth = catalog.get_nominal_depth(subsite, node, sensor)
     if nominal_depth is None:
         return set()
     if is_mobile(node):
@@ -78,7 +76,7 @@ def get_within(refdes, meters):
     if is_mobile(node):
         return set()
 
-    nominal_depth = NominalDepth.get_nominal_depth(subsite, node, sensor)
+    nominal_depth = catalog.get_nominal_depth(subsite, node, sensor)
     if nominal_depth is None:
         print 'MISSING NOMINAL DEPTH RECORD: %r' % refdes
         return set()
@@ -143,7 +141,7 @@ def resolve_parameter(refdes, method, stream, param, stream_map, m2m, depth=1):
     :throws: ParameterException if input parameter is invalid or if unable to resolve all required parameters
     """
     required = []
-    s = Stream.query.filter(Stream.name == stream).first()
+    s = catalog.get_stream_by_name(stream)
     depth_variance = 17 if 'METBK' in refdes else 6
     needs = s.needs
     if needs:
@@ -209,7 +207,7 @@ def resolve_parameter(refdes, method, stream, param, stream_map, m2m, depth=1):
 
 
 def resolve_stream(refdes, method, stream, stream_map, m2m):
-    s = Stream.query.filter(Stream.name == stream).first()
+    s = catalog.get_stream_by_name(stream)
     depth_variance = 17 if 'METBK' in refdes else 6
     needs = s.needs
     if needs:
@@ -297,13 +295,13 @@ def lookup_parameter(parameter_name, stream_name, reference_designator, method):
     Lookup a parameter by name, stream, reference designator and stream method.
     :return:  fully qualified parameter object (including location and stream)
     """
-    s = Stream.query.filter(Stream.name == stream_name).first()
+    s = catalog.get_stream_by_name(stream_name)
     parameter = next((x for x in s.parameters if x.name == parameter_name), None)
     return QualifiedParameter(parameter, reference_designator, method, stream_name)
 
 
 def get_parameter(stream_name, parameter_name):
-    s = Stream.query.filter(Stream.name == stream_name).first()
+    s = catalog.get_stream_by_name(stream_name)
     return next((x for x in s.parameters if x.name == parameter_name), None)
 
 
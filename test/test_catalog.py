@@ -0,0 +1,75 @@
+import unittest
+
+from ooi_data.postgres.model import MetadataBase, Parameter, Stream, NominalDepth
+
+from catalog import PreloadCatalog
+from database import create_engine_from_url
+from database import create_scoped_session
+
+
+def ids(items):
+    return {item.id for item in items}
+
+
+def need_ids(needs):
+    return {(stream.id if stream is not None else None, tuple(p.id for p in poss_params))
+            for stream, poss_params in needs}
+
+
+class TestCatalog(unittest.TestCase):
+    """Verify the catalog reproduces the ORM view of preload"""
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine_from_url(None)
+        session = create_scoped_session(engine)
+        MetadataBase.query = session.query_property()
+        cls.catalog = PreloadCatalog(engine)
+
+    def test_parameters(self):
+        parameters = Parameter.query.all()
+        self.assertEqual(ids(parameters), set(self.catalog.parameters))
+        for p in parameters:
+            cp = self.catalog.get_parameter(p.id)
+            for attr in ['name', 'netcdf_name', 'unit', 'value_encoding', 'parameter_type', 'fill_value',
+                         'code_set', 'data_product_identifier', 'parameter_function_id', 'is_function']:
+                self.assertEqual(getattr(p, attr), getattr(cp, attr), '%r %s' % (p, attr))
+            self.assertEqual(ids(p.streams), ids(cp.streams))
+
+    def test_parameter_needs(self):
+        for p in Parameter.query:
+            if p.is_function:
+                cp = self.catalog.get_parameter(p.id)
+                self.assertEqual(need_ids(p.needs), need_ids(cp.needs), p)
+                self.assertEqual(set(p.needs_cc), set(cp.needs_cc), p)
+
+    def test_streams(self):
+        streams = Stream.query.all()
+        self.assertEqual(ids(streams), set(self.catalog.streams))
+        for s in streams:
+            cs = self.catalog.get_stream_by_name(s.name)
+            self.assertEqual(s.id, cs.id)
+            self.assertEqual([p.id for p in s.parameters], [p.id for p in cs.parameters])
+            self.assertEqual(ids(s.source_streams), ids(cs.source_streams))
+            self.assertEqual(need_ids(s.needs), need_ids(cs.needs), s)
+            self.assertEqual(set(s.needs_cc), set(cs.needs_cc), s)
+
+    def test_dpi(self):
+        for dpi in ['PRACSAL_L2', 'TEMPWAT_L1', 'PRESWAT_L1']:
+            expected = Parameter.query.filter(Parameter.data_product_identifier == dpi).all()
+            self.assertEqual(ids(expected), ids(self.catalog.get_parameters_by_dpi(dpi)))
+
+    def test_nominal_depths(self):
+        for nd in NominalDepth.query:
+            cnd = self.catalog.get_nominal_depth(nd.subsite, nd.node, nd.sensor)
+            self.assertEqual(nd.depth, cnd.depth)
+            self.assertEqual(ids(nd.get_colocated_subsite()), ids(cnd.get_colocated_subsite()))
+            self.assertEqual(ids(nd.get_colocated_node()), ids(cnd.get_colocated_node()))
+            self.assertEqual(ids(nd.get_depth_within(6)), ids(cnd.get_depth_within(6)))
+
+    def test_immutable(self):
+        with self.assertRaises(TypeError):
+            self.catalog.parameters[0] = None
+        stream = self.catalog.get_stream_by_name('ctdbp_no_sample')
+        self.assertIsInstance(stream.parameters, tuple)
+        self.assertIsInstance(stream.parameters[0].streams, tuple)
+        self.assertIsInstance(self.catalog.get_parameters_by_dpi('PRACSAL_L2'), tuple)
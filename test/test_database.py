@@ -0,0 +1,265 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import database
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.original_cache_dir = database.PRELOAD_DATABASE_CACHE_DIR
+        database.PRELOAD_DATABASE_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        database.PRELOAD_DATABASE_CACHE_DIR = self.original_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def test_snapshot_built_once(self):
+        path = database.get_preload_database_snapshot()
+        self.assertTrue(os.path.exists(path))
+        self.assertIn(database.get_preload_database_snapshot_digest(), os.path.basename(path))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+        mtime = os.path.getmtime(path)
+        self.assertEqual(database.get_preload_database_snapshot(), path)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_stale_snapshots_removed(self):
+        stale = database.get_preload_database_snapshot_path('0' * 40)
+        open(stale, 'w').close()
+        database.get_preload_database_snapshot()
+        self.assertFalse(os.path.exists(stale))
+
+    def test_other_script_snapshots_kept(self):
+        original_path = database.PRELOAD_DATABASE_SCRIPT_FILE_PATH
+        database.PRELOAD_DATABASE_SCRIPT_FILE_PATH = os.path.join(self.cache_dir, 'other', 'preload_database.sql')
+        try:
+            other = database.get_preload_database_snapshot_path('0' * 40)
+        finally:
+            database.PRELOAD_DATABASE_SCRIPT_FILE_PATH = original_path
+        open(other, 'w').close()
+        database.get_preload_database_snapshot()
+        self.assertTrue(os.path.exists(other))
+
+    def test_snapshot_keyed_by_indexes(self):
+        digest = database.get_preload_database_snapshot_digest()
+        original_indexes = database.PRELOAD_INDEXES
+        database.PRELOAD_INDEXES = original_indexes + [('ix_stream_name', 'stream', ('name',))]
+        try:
+            self.assertNotEqual(database.get_preload_database_snapshot_digest(), digest)
+        finally:
+            database.PRELOAD_INDEXES = original_indexes
+
+    def test_snapshot_matches_script(self):
+        expected = sqlite3.connect(':memory:')
+        expected.executescript(database.get_preload_database_script_as_string())
+
+        actual = sqlite3.connect(':memory:')
+        database.copy_snapshot(database.get_preload_database_snapshot(), actual)
+
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+        tables = [row[0] for row in expected.execute(query)]
+        self.assertEqual(tables, [row[0] for row in actual.execute(query)])
+        for table in tables:
+            query = 'SELECT * FROM "%s" ORDER BY 1, 2' % table
+            self.assertEqual(expected.execute(query).fetchall(), actual.execute(query).fetchall())
+
+    def test_snapshot_indexed(self):
+        connection = sqlite3.connect(database.get_preload_database_snapshot())
+        indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for name, _, _ in database.PRELOAD_INDEXES:
+            self.assertIn(name, indexes)
+
+
+class TestReadOnly(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'preload.sqlite')
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE stream (id INTEGER PRIMARY KEY, name TEXT)')
+        connection.commit()
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @unittest.skipUnless(sys.version_info[0] > 2 or database.sqlite_uri_filenames(), 'SQLite URIs not available')
+    def test_immutable(self):
+        connection = database.connect_read_only(self.path)
+        # not merely query-only, the file itself is opened read-only
+        connection.execute('PRAGMA query_only = 0')
+        with self.assertRaises(sqlite3.OperationalError):
+            connection.execute("INSERT INTO stream VALUES (1, 'ctd')")
+        self.assertEqual(os.listdir(self.directory), ['preload.sqlite'])
+
+
+class TestTables(unittest.TestCase):
+    tables = ['stream', 'parameter']
+
+    def assertOnlyTablesLoaded(self, connection):
+        names = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertIn('nominal_depth', names)
+        for name in names:
+            count = connection.execute('SELECT COUNT(*) FROM "%s"' % name).fetchone()[0]
+            if name in self.tables:
+                self.assertGreater(count, 0, name)
+            else:
+                self.assertEqual(count, 0, name)
+
+    def test_script_tables(self):
+        connection = sqlite3.connect(':memory:')
+        connection.executescript(database.get_preload_database_script_as_string(self.tables))
+        self.assertOnlyTablesLoaded(connection)
+
+    def test_snapshot_tables(self):
+        connection = sqlite3.connect(':memory:')
+        database.copy_snapshot(database.get_preload_database_snapshot(), connection, self.tables)
+        self.assertOnlyTablesLoaded(connection)
+
+    def test_statements(self):
+        statements = list(database.iter_preload_database_script_statements())
+        self.assertEqual(''.join(statements), database.get_preload_database_script_as_string())
+        self.assertEqual('stream', database.get_statement_table(
+            next(s for s in statements if s.startswith('INSERT INTO "stream"'))))
+
+
+class TestCompactDump(unittest.TestCase):
+    def test_round_trip(self):
+        expected = sqlite3.connect(':memory:')
+        expected.executescript(database.get_preload_database_script_as_string())
+
+        script = '\n'.join(database.iter_compact_dump(expected, batch_size=100))
+        actual = sqlite3.connect(':memory:')
+        actual.executescript(script)
+
+        query = "SELECT type, name, sql FROM sqlite_master ORDER BY type, name"
+        self.assertEqual(expected.execute(query).fetchall(), actual.execute(query).fetchall())
+        for table, in expected.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+            query = 'SELECT * FROM "%s" ORDER BY 1, 2' % table
+            self.assertEqual(expected.execute(query).fetchall(), actual.execute(query).fetchall())
+
+    def test_stable(self):
+        connection = sqlite3.connect(':memory:')
+        connection.executescript(database.get_preload_database_script_as_string())
+        self.assertEqual(list(database.iter_compact_dump(connection)), list(database.iter_compact_dump(connection)))
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.expected = sqlite3.connect(':memory:')
+        self.expected.executescript(database.get_preload_database_script_as_string())
+
+        self.script_dir = tempfile.mkdtemp()
+        self.original_script = database.PRELOAD_DATABASE_SCRIPT_FILE_PATH
+        database.PRELOAD_DATABASE_SCRIPT_FILE_PATH = os.path.join(self.script_dir, 'preload_database.sql')
+
+    def tearDown(self):
+        database.PRELOAD_DATABASE_SCRIPT_FILE_PATH = self.original_script
+        shutil.rmtree(self.script_dir)
+
+    def assertLoads(self, compression, suffix):
+        database.generate_script_from_preload_database(self.expected, compression=compression)
+        self.assertEqual(database.get_preload_database_script_path(),
+                         database.PRELOAD_DATABASE_SCRIPT_FILE_PATH + suffix)
+
+        actual = sqlite3.connect(':memory:')
+        database.load_preload_database_script(actual)
+        for table, in self.expected.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+            query = 'SELECT * FROM "%s" ORDER BY 1, 2' % table
+            self.assertEqual(self.expected.execute(query).fetchall(), actual.execute(query).fetchall())
+
+    def test_gzip(self):
+        self.assertLoads('gzip', '.gz')
+
+    @unittest.skipIf(database.lzma is None, 'lzma not available')
+    def test_xz(self):
+        self.assertLoads('xz', '.xz')
+
+    def test_gzip_reproducible(self):
+        database.generate_script_from_preload_database(self.expected, compression='gzip')
+        digest = database.get_preload_database_script_hash()
+        database.generate_script_from_preload_database(self.expected, compression='gzip')
+        self.assertEqual(database.get_preload_database_script_hash(), digest)
+
+    def test_replaces_other_formats(self):
+        database.generate_script_from_preload_database(self.expected)
+        database.generate_script_from_preload_database(self.expected, compression='gzip')
+        self.assertFalse(os.path.exists(database.PRELOAD_DATABASE_SCRIPT_FILE_PATH))
+
+
+class TestStartupTiming(unittest.TestCase):
+    def test_phase(self):
+        output = StringIO()
+        timing = database.StartupTiming(output)
+        with timing.phase('load', tables=['stream']):
+            connection = sqlite3.connect(':memory:')
+            database.load_preload_database_script(connection, ['stream'])
+
+        record = json.loads(output.getvalue())
+        self.assertEqual(timing.phases, [record])
+        self.assertEqual(record['phase'], 'load')
+        self.assertEqual(record['tables'], ['stream'])
+        self.assertGreater(record['seconds'], 0)
+        self.assertGreater(record['peak_rss_kb'], 0)
+        self.assertGreaterEqual(record['peak_rss_growth_kb'], 0)
+
+    def test_disabled(self):
+        original = database.PRELOAD_TIMING
+        database.PRELOAD_TIMING = None
+        try:
+            self.assertIsNone(database.get_startup_timing())
+            self.assertIsInstance(database.get_startup_timing(True), database.StartupTiming)
+        finally:
+            database.PRELOAD_TIMING = original
+
+
+class TestFork(unittest.TestCase):
+    tables = ['stream']
+
+    def run_in_child(self, function):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write_fd, json.dumps(function()).encode('utf8'))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fh:
+            result = fh.read()
+        os.waitpid(pid, 0)
+        return json.loads(result)
+
+    def count_streams(self, engine):
+        return engine.execute('SELECT COUNT(*) FROM stream').scalar()
+
+    def test_engine_per_process(self):
+        engine = database.get_engine(tables=self.tables)
+        self.assertIs(database.get_engine(tables=self.tables), engine)
+        expected = self.count_streams(engine)
+
+        def child():
+            child_engine = database.get_engine(tables=self.tables)
+            return [child_engine is not engine, self.count_streams(child_engine)]
+
+        self.assertEqual(self.run_in_child(child), [True, expected])
+        # the parent's engine is still usable after the child exits
+        self.assertEqual(self.count_streams(engine), expected)
+
+    def test_session_per_process(self):
+        Session = database.create_process_scoped_session(tables=self.tables)
+        session = Session()
+        expected = session.execute('SELECT COUNT(*) FROM stream').scalar()
+
+        def child():
+            child_session = Session()
+            return [child_session is not session, child_session.execute('SELECT COUNT(*) FROM stream').scalar()]
+
+        self.assertEqual(self.run_in_child(child), [True, expected])
+        Session.remove()
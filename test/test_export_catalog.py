@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from database import create_engine_from_url
+from export_catalog import load_catalog, load_catalog_arrays, read_catalog_tables, write_catalog, PRELOAD_TABLES
+
+
+class TestExportCatalog(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine_from_url(None, tables=PRELOAD_TABLES)
+        cls.frames = read_catalog_tables(engine)
+        engine.dispose()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_types(self):
+        parameters = self.frames['parameter']
+        self.assertEqual(parameters['id'].dtype, 'int64')
+        self.assertEqual(parameters['visible'].dtype, 'float64')
+        self.assertEqual(set(parameters['visible']), {0.0, 1.0})
+        self.assertEqual(parameters['unit'].dtype.name, 'category')
+        self.assertTrue(parameters['parameter_function_id'].isnull().any())
+        self.assertTrue(parameters['data_product_identifier'].isnull().any())
+
+    def test_missing_visible(self):
+        # a NULL visible is exported as missing, not as False
+        engine = create_engine_from_url(None, tables=PRELOAD_TABLES)
+        engine.execute('UPDATE parameter SET visible = NULL WHERE id = 7')
+        parameters = read_catalog_tables(engine)['parameter']
+        engine.dispose()
+        self.assertEqual(parameters.id[parameters.visible.isnull()].tolist(), [7])
+
+        write_catalog({'parameter': parameters}, self.directory, 'npz')
+        parameters = load_catalog(self.directory)['parameter']
+        self.assertEqual(parameters.id[parameters.visible.isnull()].tolist(), [7])
+
+    def test_stream_parameters(self):
+        counts = self.frames['stream_parameter'].groupby('stream_id').size()
+        self.assertEqual(set(counts.index), set(self.frames['stream']['id']))
+        self.assertTrue((counts > 0).all())
+
+    def test_npz_round_trip(self):
+        write_catalog(self.frames, self.directory, 'npz')
+        frames = load_catalog(self.directory)
+        self.assertEqual(sorted(frames), sorted(self.frames))
+        for table, frame in self.frames.items():
+            pd.util.testing.assert_frame_equal(frame, frames[table])
+
+    def test_arrays(self):
+        write_catalog(self.frames, self.directory, 'npz')
+        arrays = load_catalog_arrays(self.directory)
+        self.assertEqual(len(arrays['parameter']), len(self.frames['parameter']))
+        self.assertEqual(list(arrays['stream'].dtype.names), list(self.frames['stream'].columns))
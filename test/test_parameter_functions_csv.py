@@ -3,10 +3,10 @@ import unittest
 
 import numpy
 import os
-import pandas
-import re
 import ast
 
+from validate_preload import catalog_report, format_errors, read_csv_frames, report_errors
+
 TEST_DIR = os.path.dirname(__file__)
 ROOT_DIR = os.path.dirname(TEST_DIR)
 CSV_DIR = os.path.join(ROOT_DIR, 'csv')
@@ -15,46 +15,25 @@ CSV_DIR = os.path.join(ROOT_DIR, 'csv')
 class TestFunctions(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        filename = os.path.join(CSV_DIR, 'ParameterFunctions.csv')
-        cls.data = pandas.read_csv(filename, na_values=[], keep_default_na=False)
-
-        # ignore DOC lines
-        cls.data = cls.data[numpy.logical_not(cls.data.scenario.str.startswith('DOC'))]
+        cls.data = read_csv_frames(CSV_DIR)['ParameterFunctions']
+        cls.report = catalog_report(CSV_DIR)
 
     def test_scenario(self):
         """ Scenario - Enforce ALL CAPS and underscore only. May be comma separated. """
-
-        def invalid_scenario(scenario):
-            p = re.compile('^[A-Z0-9,_ ]+$')
-            if p.match(scenario):
-                return False
-            return True
-
-        idx = self.data.scenario != ''
-        idx = self.data.scenario[idx].map(invalid_scenario)
-        self.assertEqual(len(self.data[idx]), 0, msg='Unrecognized scenario names detected:\n%s' %
-                                                     (self.data[idx][['id', 'scenario']]))
+        errors = report_errors(self.report, 'scenario', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
 
     def test_id(self):
         """ ID - Must be unique. """
-        pf_id, counts = numpy.unique(self.data.id, return_counts=True)
-        self.assertListEqual(list(pf_id[counts > 1]), [])
+        errors = report_errors(self.report, 'duplicate_id', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
 
     # HID - deprecate - ignore - old formula = <Name>_<InstClass>_<InstSer>
 
     def test_name(self):
         """ Name - Must not contain spaces. """
-
-        def invalid_name(name):
-            p = re.compile('^[a-zA-Z0-9_\-]+$')
-            if p.match(name):
-                return False
-            return True
-
-        idx = self.data.name != ''
-        idx = self.data.name[idx].map(invalid_name)
-        self.assertEqual(len(self.data[idx]), 0, msg='Unrecognized name detected:\n%s' %
-                                                     (self.data[idx][['id', 'name']]))
+        errors = report_errors(self.report, 'name', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
 
     # Instrument Class - ignore - this isn't used
     # Instrument Series - ignore - this isn't used
@@ -62,12 +41,8 @@ class TestFunctions(unittest.TestCase):
     def test_function_type(self):
         """ Function Type - Must be one of the following: { 'NumexprFunction', 'PythonFunction', 'QCPythonFunction' }.
         """
-        function_types = {'NumexprFunction', 'PythonFunction', 'QCPythonFunction'}
-        idx = self.data.functiontype.isin(function_types) | (self.data.functiontype == '')
-        idx = numpy.logical_not(idx)
-        self.assertEqual(len(self.data[idx]), 0, msg='Unrecognized function type detected:\n%s\n'
-                                                     'Must be one of: %s' %
-                                                     (self.data[idx][['id', 'functiontype']], function_types))
+        errors = report_errors(self.report, 'function_type', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
 
     def test_owner(self):
         """
@@ -136,30 +111,13 @@ class TestFunctions(unittest.TestCase):
 
     def test_description(self):
         """ Description - Maximum of 4096 characters. """
-        max_description = 4096  # TODO - pull from the parse_preload code
-
-        def description_too_long(dstring):
-            if len(dstring) > max_description:
-                return True
-            return False
-
-        idx = self.data.description.map(description_too_long)
-        self.assertEqual(len(self.data[idx]), 0, msg='Description longer than limit %d\n%s' %
-                                                     (max_description, self.data[idx][['id', 'description']]))
+        errors = report_errors(self.report, 'description', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
 
     # Reference - ignore
     # SKIP - ignore
 
     def test_qc_flag(self):
         """ QC_Flag - If present, must be of the form 0b0000000000000001. """
-
-        def invalid_qc_flag(flag):
-            if not len(flag):
-                return False
-            p = re.compile('^[0][b][0-1]{16}$')
-            if p.match(flag):
-                return False
-            return True
-
-        idx = self.data.qcflag.map(invalid_qc_flag)
-        self.assertEqual(len(self.data[idx]), 0, msg='Invalid qc flag format:\n%s' % (self.data[idx][['id', 'qcflag']]))
+        errors = report_errors(self.report, 'qc_flag', 'ParameterFunctions')
+        self.assertEqual(errors, [], msg=format_errors(self.report, errors))
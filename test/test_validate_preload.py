@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from validate_preload import format_errors, loadable_rows, read_csv_frames, report_errors, validate_catalog
+
+
+def frame(rows, columns):
+    return pd.DataFrame(rows, columns=columns)
+
+
+class TestValidateCatalog(unittest.TestCase):
+    def setUp(self):
+        self.frames = {
+            'ParameterDefs': frame([
+                ['', 'PD1', 'time', 'quantity', 'float64', '-9999999', '', '', ''],
+                ['', 'PD2', 'temp', 'quantity', 'int8', '300', '', 'PFID1', '{"a": "PD1", "b": ["PD1", "PD9"], "c": "PD8"}'],
+                ['', 'PD2', 'dup', 'vector', 'float32', '', 'x', 'PFID7', ''],
+            ], ['scenario', 'id', 'name', 'parametertype', 'valueencoding', 'fillvalue', 'precision',
+                'parameterfunctionid', 'parameterfunctionmap']),
+            'ParameterFunctions': frame([
+                ['', 'PFID1', 'func', 'PythonFunction', 'f'],
+            ], ['scenario', 'id', 'name', 'functiontype', 'function']),
+            'ParameterDictionary': frame([
+                ['CTD', 'DICT1', 'ctd', 'PD1, PD2', ''],
+                ['bad scenario', 'DICT2', 'ctd_derived', 'PD1,PD3', 'DICT1, DICT5'],
+            ], ['scenario', 'id', 'name', 'parameterids', 'streamdependency']),
+        }
+
+    def test_errors(self):
+        report = validate_catalog(self.frames)
+        self.assertEqual(report['rows'], {'ParameterDefs': 3, 'ParameterFunctions': 1, 'ParameterDictionary': 2})
+
+        def errors(check, csv_file=None):
+            return [(error['id'], error['value']) for error in report_errors(report, check, csv_file)]
+
+        self.assertEqual(errors('duplicate_id', 'ParameterDefs'), [('PD2', 'PD2'), ('PD2', 'PD2')])
+        self.assertEqual(errors('duplicate_id', 'ParameterDictionary'), [])
+        self.assertEqual(errors('parameter_type'), [('PD2', 'vector')])
+        self.assertEqual(errors('fill_value'), [('PD2', '300')])
+        self.assertEqual(errors('precision'), [('PD2', 'x')])
+        self.assertEqual(errors('function_id_defined'), [('PD2', 'PFID7')])
+        self.assertEqual(errors('function_map'), [('PD2', '')])
+        self.assertEqual(errors('function_map_ids'), [('PD2', 'PD8')])
+        self.assertEqual(errors('function_map_list_ids'), [('PD2', 'PD9')])
+        self.assertEqual(errors('scenario'), [('DICT2', 'bad scenario')])
+        self.assertEqual(errors('parameter_ids'), [('DICT2', 'PD3')])
+        self.assertEqual(errors('stream_dependency'), [('DICT2', 'DICT5')])
+
+        self.assertEqual(format_errors(report, report_errors(report, 'parameter_ids')),
+                         "ParameterDictionary parameterids: Each parameter must be defined\n"
+                         "  DICT2 (row 3): 'PD3'")
+        self.assertEqual(format_errors(report, report_errors(report, 'duplicate_id', 'ParameterDefs')),
+                         "ParameterDefs id: Every parameter id must be unique\n"
+                         "  PD2 (row 3): 'PD2'\n"
+                         "  PD2 (row 4): 'PD2'")
+
+        # checks of columns which were not read are skipped
+        checks = {(check['check'], check['file']) for check in report['checks']}
+        self.assertIn(('fill_value', 'ParameterDefs'), checks)
+        self.assertNotIn(('qc_flag', 'ParameterFunctions'), checks)
+
+    def test_missing_values(self):
+        # load_preload reads missing values as None
+        frames = {name: df.where(df != '', None) for name, df in self.frames.items()}
+        self.assertEqual(validate_catalog(frames)['errors'], validate_catalog(self.frames)['errors'])
+
+    def test_loadable_rows(self):
+        data = frame([
+            ['CTD', 'PD1', 'time', 'quantity', 'float64'],
+            ['CTD, VOID', 'PD2', 'void', 'quantity', 'float64'],
+            [None, 'PD3', 'nothing', 'quantity', None],
+            [None, 'DICT4', 'stream', 'quantity', 'float64'],
+            [None, 'PD5', 'unscoped', 'quantity', 'float64'],
+        ], ['scenario', 'id', 'name', 'parametertype', 'valueencoding'])
+        self.assertEqual(list(loadable_rows(data, 'ParameterDefs').id), ['PD1', 'PD5'])
+
+    def test_doc_rows(self):
+        directory = tempfile.mkdtemp()
+        try:
+            rows = [['DOC:Definition', 'Unique id'], ['DOC', 'PD1'], ['', 'PD2']]
+            for csv_file in ['ParameterDefs', 'ParameterFunctions', 'ParameterDictionary']:
+                frame(rows, ['scenario', 'id']).to_csv(os.path.join(directory, '%s.csv' % csv_file), index=False)
+            frames = read_csv_frames(directory)
+        finally:
+            shutil.rmtree(directory)
+        # only DOC: rows are documentation in ParameterDefs, any DOC scenario in the other files
+        self.assertEqual(list(frames['ParameterDefs'].id), ['PD1', 'PD2'])
+        self.assertEqual(list(frames['ParameterFunctions'].id), ['PD2'])
+        self.assertEqual(list(frames['ParameterDictionary'].id), ['PD2'])
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+Usage:
+    validate_preload.py [--csv-dir=<dir>]
+
+Options:
+    --csv-dir=<dir>  Directory containing the preload CSV files [default: csv]
+
+    Validate ParameterDefs.csv, ParameterFunctions.csv and ParameterDictionary.csv and write
+    the report to stdout as JSON. The exit status is 1 if any check failed.
+"""
+import ast
+import json
+import os
+import sys
+
+import docopt
+import numpy as np
+import pandas as pd
+
+CSV_DIR = os.path.join(os.path.dirname(__file__), 'csv')
+CSV_FILES = ['ParameterDefs', 'ParameterFunctions', 'ParameterDictionary']
+IGNORE_SCENARIOS = ['VOID', 'DOC', 'DOC:WARNING', 'NOTE']
+# Scenario prefix of the documentation rows of each CSV file, which are not validated
+DOC_PREFIXES = {'ParameterDefs': 'DOC:', 'ParameterFunctions': 'DOC', 'ParameterDictionary': 'DOC'}
+
+# Prefix of the ids and mandatory columns of the rows load_preload applies to the database
+LOAD_RULES = {
+    'ParameterDefs': ('PD', ['id', 'name', 'parametertype', 'valueencoding']),
+    'ParameterFunctions': ('PFID', ['id', 'functiontype', 'function']),
+    'ParameterDictionary': ('DICT', ['id', 'name', 'parameterids']),
+}
+
+PARAMETER_TYPES = {'scalar', 'array1', 'array2',
+                   # deprecated
+                   'array', 'array<>', 'array<quantity>', 'binary', 'boolean', 'category<int8:str>',
+                   'category<uint8:str>', 'constant<str>', 'external', 'function', 'quantity', 'record<>'}
+VALUE_ENCODINGS = {'float32', 'float64', 'int', 'int8', 'int16', 'int32', 'int64', 'opaque', 'string', 'uint8',
+                   'uint16', 'uint32', 'uint64'}
+# Range of the fill values of each numeric value encoding, with the suggested fill value
+VALUE_ENCODING_LIMITS = {
+    'boolean': (0, 1, 0),
+    'float32': (np.finfo(np.float32).min, np.finfo(np.float32).max, 'nan'),
+    'float64': (np.finfo(np.float64).min, np.finfo(np.float64).max, 'nan'),
+    'int': (np.iinfo(np.int32).min, np.iinfo(np.int32).max, -9999),
+    'int8': (np.iinfo(np.int8).min, np.iinfo(np.int8).max, -99),
+    'int16': (np.iinfo(np.int16).min, np.iinfo(np.int16).max, -9999),
+    'int32': (np.iinfo(np.int32).min, np.iinfo(np.int32).max, -9999),
+    'int64': (np.iinfo(np.int64).min, np.iinfo(np.int64).max, -9999),
+    'uint8': (np.iinfo(np.uint8).min, np.iinfo(np.uint8).max, 0),
+    'uint16': (np.iinfo(np.uint16).min, np.iinfo(np.uint16).max, 0),
+    'uint32': (np.iinfo(np.uint32).min, np.iinfo(np.uint32).max, 0),
+    'uint64': (np.iinfo(np.uint64).min, np.iinfo(np.uint64).max, 0),
+}
+DATA_PRODUCT_TYPES = {'Auxiliary Data', 'Data Product Type', 'Engineering Data', 'Science Data', 'Unprocessed Data'}
+DATA_LEVELS = {'L0', 'L1', 'L2'}
+FUNCTION_TYPES = {'NumexprFunction', 'PythonFunction', 'QCPythonFunction'}
+TEMPORAL_PARAMETERS = {'PD7', 'PD3655', 'PD3660', 'PD3665', 'PD3074'}
+STREAM_TYPES = {'Science', 'Engineering', 'Calibration'}
+MAX_DESCRIPTION = 4096
+
+_frames = {}
+_reports = {}
+
+
+def read_csv_frames(csv_dir=CSV_DIR):
+    """
+    Read the CSV files as text, without the DOC rows. Missing values are empty strings.
+    The frames are read once per directory.
+    """
+    if csv_dir not in _frames:
+        frames = {}
+        for csv_file in CSV_FILES:
+            df = pd.read_csv(os.path.join(csv_dir, '%s.csv' % csv_file), encoding='utf-8', dtype=object,
+                             na_values=[], keep_default_na=False)
+            frames[csv_file] = df[np.logical_not(df.scenario.str.startswith(DOC_PREFIXES[csv_file]))]
+        _frames[csv_dir] = frames
+    return _frames[csv_dir]
+
+
+def split_list(column, sep=','):
+    # Each item of a column of separated lists, indexed by the row index (repeated for each item)
+    items = column.str.replace(' ', '').str.split(sep, expand=True).stack().dropna()
+    return items.reset_index(level=1, drop=True)
+
+
+def not_in(column, values):
+    return column[np.logical_not(column.isin(values))]
+
+
+def not_matching(column, pattern):
+    # Non-empty values which do not match pattern (from the start of the value)
+    return column[(column != '') & np.logical_not(column.str.match(pattern))]
+
+
+def unique_map(column, func):
+    # Apply func once to each distinct value of column
+    values = column.unique()
+    return column.map(dict(zip(values, [func(value) for value in values])))
+
+
+def is_dictionary(value):
+    try:
+        return isinstance(ast.literal_eval(value), dict)
+    except (SyntaxError, ValueError):
+        return False
+
+
+def parse_function_map(value):
+    try:
+        function_map = json.loads(value)
+    except ValueError:
+        return None
+    if isinstance(function_map, dict):
+        return function_map
+
+
+def check_code_set(frames):
+    data = frames['ParameterDefs'].codeset
+    data = data[data != '']
+    return data[np.logical_not(unique_map(data, is_dictionary))]
+
+
+def check_fill_value(frames):
+    data = frames['ParameterDefs']
+    data = data[data.valueencoding.isin(VALUE_ENCODING_LIMITS)]
+    # No range checks on NaN values (nan or an empty string) for floats
+    data = data[np.logical_not(data.valueencoding.isin({'float32', 'float64'}) & data.fillvalue.isin({'nan', ''}))]
+    values = pd.to_numeric(data.fillvalue, errors='coerce')
+    minimum = data.valueencoding.map({key: limits[0] for key, limits in VALUE_ENCODING_LIMITS.items()})
+    maximum = data.valueencoding.map({key: limits[1] for key, limits in VALUE_ENCODING_LIMITS.items()})
+    return data.fillvalue[values.isnull() | (values < minimum) | (values > maximum)]
+
+
+def check_function_map(frames):
+    # The function map must be a JSON object if either it or the function id is present
+    data = frames['ParameterDefs']
+    data = data[(data.parameterfunctionid != '') | (data.parameterfunctionmap != '')]
+    maps = unique_map(data.parameterfunctionmap, parse_function_map)
+    return data.parameterfunctionmap[maps.isnull()]
+
+
+def function_map_references(in_lists):
+    def check(frames):
+        # Each PD given as an argument of a function map (or in a list argument if in_lists) must be defined
+        data = frames['ParameterDefs']
+        data = data[data.parameterfunctionmap != '']
+        references = {}
+        for value in data.parameterfunctionmap.unique():
+            found = set()
+            for arg in (parse_function_map(value) or {}).values():
+                if isinstance(arg, list) == in_lists:
+                    for each in arg if in_lists else [arg]:
+                        if isinstance(each, basestring) and each.startswith('PD'):
+                            found.add(each)
+            references[value] = sorted(found)
+        pairs = [(index, each) for index, value in data.parameterfunctionmap.iteritems()
+                 for each in references[value]]
+        if not pairs:
+            return pd.Series([], dtype=object)
+        index, values = zip(*pairs)
+        return not_in(pd.Series(values, index=index), frames['ParameterDefs'].id)
+    return check
+
+
+def check_function_map_pfid(frames):
+    data = frames['ParameterDefs']
+    data = data[data.parameterfunctionmap != '']
+    return data.parameterfunctionid[np.logical_not(data.parameterfunctionid.str.startswith('PFID'))]
+
+
+def check_function_id_defined(frames):
+    data = frames['ParameterDefs']
+    return not_in(data.parameterfunctionid[data.parameterfunctionid != ''], frames['ParameterFunctions'].id)
+
+
+def check_precision(frames):
+    data = frames['ParameterDefs']
+    return not_matching(data.precision[data.precision != 'default'], r'^\s*[-+]?\d+\s*$')
+
+
+def check_parameter_ids(frames):
+    data = frames['ParameterDictionary']
+    return not_in(split_list(data.parameterids), frames['ParameterDefs'].id)
+
+
+def check_stream_dependency(frames):
+    data = frames['ParameterDictionary']
+    return not_in(split_list(data.streamdependency[data.streamdependency != '']), data.id)
+
+
+def check_description(frames):
+    data = frames['ParameterFunctions'].description
+    return data[data.str.len() > MAX_DESCRIPTION]
+
+
+def duplicate_ids(csv_file):
+    def check(frames):
+        ids = frames[csv_file].id
+        return ids[ids.duplicated(keep=False)]
+    return check
+
+
+def one_of(csv_file, column, values, optional=True):
+    def check(frames):
+        data = frames[csv_file][column]
+        return not_in(data[data != ''] if optional else data, values)
+    return check
+
+
+def matching(csv_file, column, pattern):
+    def check(frames):
+        return not_matching(frames[csv_file][column], pattern)
+    return check
+
+
+# name, CSV file, column, rule and the function returning the offending values indexed by row
+CHECKS = [
+    ('duplicate_id', 'ParameterDefs', 'id', 'Every parameter id must be unique',
+     duplicate_ids('ParameterDefs')),
+    ('parameter_type', 'ParameterDefs', 'parametertype', 'Must be one of %s' % sorted(PARAMETER_TYPES),
+     one_of('ParameterDefs', 'parametertype', PARAMETER_TYPES, optional=False)),
+    ('value_encoding', 'ParameterDefs', 'valueencoding', 'Must be empty or one of %s' % sorted(VALUE_ENCODINGS),
+     one_of('ParameterDefs', 'valueencoding', VALUE_ENCODINGS)),
+    ('code_set', 'ParameterDefs', 'codeset', 'Must be empty or a valid dictionary',
+     check_code_set),
+    ('fill_value', 'ParameterDefs', 'fillvalue', 'Must be a number within the range of the value encoding',
+     check_fill_value),
+    ('precision', 'ParameterDefs', 'precision', "Must be empty, an integer or 'default'", check_precision),
+    ('visible', 'ParameterDefs', 'visible', 'Must be TRUE, FALSE or empty',
+     one_of('ParameterDefs', 'visible', {'TRUE', 'FALSE'})),
+    ('function_id', 'ParameterDefs', 'parameterfunctionid', 'Must be empty or of the form PFID#',
+     matching('ParameterDefs', 'parameterfunctionid', r'PFID\d+')),
+    ('function_id_defined', 'ParameterDefs', 'parameterfunctionid', 'The parameter function must be defined',
+     check_function_id_defined),
+    ('function_map', 'ParameterDefs', 'parameterfunctionmap',
+     'Must be a JSON object if the parameter function id is present', check_function_map),
+    ('function_map_ids', 'ParameterDefs', 'parameterfunctionmap', 'Each PD of the function map must be defined',
+     function_map_references(in_lists=False)),
+    ('function_map_list_ids', 'ParameterDefs', 'parameterfunctionmap',
+     'Each PD in a list of the function map must be defined', function_map_references(in_lists=True)),
+    ('function_map_pfid', 'ParameterDefs', 'parameterfunctionid',
+     'The parameter function id must be present if the function map is', check_function_map_pfid),
+    ('qc_functions', 'ParameterDefs', 'qcfunctions', 'Must match the format AAA-[AAA]',
+     matching('ParameterDefs', 'qcfunctions', r'[A-Z]+(\-[A-Z]+)*')),
+    ('data_product_type', 'ParameterDefs', 'dataproducttype',
+     'Must be empty or one of %s' % sorted(DATA_PRODUCT_TYPES),
+     one_of('ParameterDefs', 'dataproducttype', DATA_PRODUCT_TYPES)),
+    ('data_level', 'ParameterDefs', 'datalevel', 'Must be empty or one of %s' % sorted(DATA_LEVELS),
+     one_of('ParameterDefs', 'datalevel', DATA_LEVELS)),
+
+    ('duplicate_id', 'ParameterFunctions', 'id', 'Every parameter function id must be unique',
+     duplicate_ids('ParameterFunctions')),
+    ('scenario', 'ParameterFunctions', 'scenario', 'Must be ALL CAPS, with underscores and commas',
+     matching('ParameterFunctions', 'scenario', r'^[A-Z0-9,_ ]+$')),
+    ('name', 'ParameterFunctions', 'name', 'Must not contain spaces',
+     matching('ParameterFunctions', 'name', r'^[a-zA-Z0-9_\-]+$')),
+    ('function_type', 'ParameterFunctions', 'functiontype', 'Must be empty or one of %s' % sorted(FUNCTION_TYPES),
+     one_of('ParameterFunctions', 'functiontype', FUNCTION_TYPES)),
+    ('description', 'ParameterFunctions', 'description', 'Maximum of %d characters' % MAX_DESCRIPTION,
+     check_description),
+    ('qc_flag', 'ParameterFunctions', 'qcflag', 'Must be empty or of the form 0b0000000000000001',
+     matching('ParameterFunctions', 'qcflag', r'^[0][b][0-1]{16}$')),
+
+    ('duplicate_id', 'ParameterDictionary', 'id', 'Every stream id must be unique',
+     duplicate_ids('ParameterDictionary')),
+    ('scenario', 'ParameterDictionary', 'scenario', 'Must be ALL CAPS, with underscores and commas',
+     matching('ParameterDictionary', 'scenario', r'^[A-Z0-9,_ ]+$')),
+    ('name', 'ParameterDictionary', 'name', 'Must be lower case alpha-numeric with optional underscores',
+     matching('ParameterDictionary', 'name', r'^[a-z0-9_\-]+$')),
+    ('parameter_ids', 'ParameterDictionary', 'parameterids', 'Each parameter must be defined', check_parameter_ids),
+    ('temporal_parameter', 'ParameterDictionary', 'temporalparameter',
+     'Must be empty or one of %s' % sorted(TEMPORAL_PARAMETERS),
+     one_of('ParameterDictionary', 'temporalparameter', TEMPORAL_PARAMETERS)),
+    ('stream_dependency', 'ParameterDictionary', 'streamdependency', 'Each stream dependency must be defined',
+     check_stream_dependency),
+    ('stream_type', 'ParameterDictionary', 'streamtype', 'Must be empty or one of %s' % sorted(STREAM_TYPES),
+     one_of('ParameterDictionary', 'streamtype', STREAM_TYPES)),
+]
+
+# Columns read by a check other than its own
+CHECK_COLUMNS = {
+    'fill_value': ['valueencoding'],
+    'function_map': ['parameterfunctionid'],
+    'function_map_pfid': ['parameterfunctionmap'],
+}
+
+
+def validate_catalog(frames):
+    """
+    Run every check in CHECKS on frames, a dict of CSV file name to DataFrame.
+
+    Missing values may be None or empty strings. Checks of columns which are not in the frames are skipped.
+    Returns the report, a dict with the number of rows of each file, the checks run (name, file, column,
+    rule and number of errors) and the errors (check, file, row id, row number, column and offending value).
+    """
+    frames = {name: frame.fillna('') for name, frame in frames.items() if name in CSV_FILES}
+    report = {'rows': {name: len(frame) for name, frame in frames.items()}, 'checks': [], 'errors': []}
+
+    for name, csv_file, column, rule, check in CHECKS:
+        columns = [column] + CHECK_COLUMNS.get(name, [])
+        if csv_file not in frames or not set(columns).issubset(frames[csv_file].columns):
+            continue
+        try:
+            invalid = check(frames)
+        except KeyError:
+            # a cross-reference to a file or column which was not read
+            continue
+
+        ids = frames[csv_file].id
+        for index, value in invalid.iteritems():
+            # the row number as in a spreadsheet, the header is row 1 (a quoted value may span several lines)
+            report['errors'].append({'check': name, 'file': csv_file, 'id': ids[index], 'row': int(index) + 2,
+                                     'column': column, 'value': value})
+        report['checks'].append({'check': name, 'file': csv_file, 'column': column, 'rule': rule,
+                                 'errors': len(invalid)})
+    return report
+
+
+def catalog_report(csv_dir=CSV_DIR):
+    """The report of the CSV files in csv_dir, validated once per directory"""
+    if csv_dir not in _reports:
+        _reports[csv_dir] = validate_catalog(read_csv_frames(csv_dir))
+    return _reports[csv_dir]
+
+
+def report_errors(report, check, csv_file=None):
+    """The errors in report from the named check, optionally only those of one CSV file"""
+    return [error for error in report['errors']
+            if error['check'] == check and csv_file in (None, error['file'])]
+
+
+def format_errors(report, errors):
+    """
+    Describe errors from report, e.g. as the message of a failed test: the rule of each check,
+    then the row id, row number and offending value of each error.
+    """
+    rules = {(check['check'], check['file']): check['rule'] for check in report['checks']}
+    lines = []
+    for error in errors:
+        key = (error['check'], error['file'])
+        if key in rules:
+            lines.append('%s %s: %s' % (error['file'], error['column'], rules.pop(key)))
+        lines.append('  %(id)s (row %(row)d): %(value)r' % error)
+    return '\n'.join(lines)
+
+
+def loadable_rows(frame, csv_file):
+    """
+    The rows of a CSV file which load_preload applies: with the id prefix and mandatory columns
+    of LOAD_RULES and without an ignored scenario.
+    """
+    prefix, mandatory = LOAD_RULES[csv_file]
+    mask = frame[mandatory].notnull().all(axis=1) & frame.id.str.startswith(prefix).fillna(False)
+    scenarios = split_list(frame.scenario.dropna())
+    ignored = scenarios.isin(IGNORE_SCENARIOS).groupby(level=0).any()
+    mask &= np.logical_not(ignored.reindex(frame.index).fillna(False).astype(bool))
+    return frame[mask]
+
+
+def main():
+    options = docopt.docopt(__doc__)
+    report = validate_catalog(read_csv_frames(options['--csv-dir']))
+    print(json.dumps(report, indent=2, sort_keys=True))
+    sys.exit(1 if report['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()